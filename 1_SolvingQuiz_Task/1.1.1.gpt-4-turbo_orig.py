@@ -1,14 +1,19 @@
 import os
+import sys
 import json
 import openai
 import io
 import base64
 from PIL import Image
 import time
-import statistics
-import pandas as pd
 from dotenv import load_dotenv
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lancet_vlm import (
+    case_sources, cassette, dedupe, imaging, jobs, ledger, logs, manifest, metrics, mock_server,
+    prompts, results, stats, timing, tracing, usage, writer,
+)
+
 parent_dir = os.path.dirname(os.getcwd())
 env_path = os.path.join(parent_dir, '.env')
 load_dotenv(env_path)
@@ -18,152 +23,159 @@ os.environ['OPENAI_API_KEY'] = os.getenv("MY_OPENAI_API_KEY")
 class GPT4VisionAnalyzer:
     def __init__(self, api_key, time_file_name="OpenAI_execution_times.xlsx"):
         self.api_key = api_key
-        self.execution_times = []
+        self.latency_stats = stats.LatencyBook()
+        self.job_timer = timing.JobTimer()
+        self.job_usage = usage.JobUsage()
         self.time_file_name = os.path.join('time', time_file_name)
-        self.df_execution_times = self.load_or_initialize_execution_times()
-        self.log_file_path = os.path.join("./", "process_log.txt")
+        self.model = "gpt-4-turbo"
+        self.task = "1_orig"
+        self.metrics = metrics.open_metrics('openai', self.model, self.task)
+        self.writer = writer.BackgroundWriter()
+        self.execution_ledger = ledger.open_ledger(
+            self.time_file_name, self.writer, jobs.namespace(self.model, self.task)
+        )
+        self.result_store = results.open_store(writer=self.writer)
+        self.run_log = logs.open_run_log(self.model, self.task)
+        self.tracer = tracing.open_tracer(self.model, self.task, self.writer, self.run_log.run_id)
+        self.cassette = cassette.open_cassette(self.model, self.task, self.writer)
+        self.token_budget = usage.open_budget()
         self.temperatures = [0, 0.5, 1]
         self.base_result_folder = "gpt4v_result/gpt4v_result"
         self.max_try = 5
-        self.image_extensions = ['.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.gif']
-
-    def load_or_initialize_execution_times(self):
-        if os.path.exists(self.time_file_name):
-            print("Loading time file")
-            return pd.read_excel(self.time_file_name)
-        else:
-            print("Creating time file")
-            return pd.DataFrame({
-                'number': pd.Series(dtype='int'),
-                'temperature': pd.Series(dtype='float'),
-                'try': pd.Series(dtype='int'),
-                'time': pd.Series(dtype='float')
-            })
+        self.case_source = None
+        self.case_range = None
+        self.crop_borders = False
+        self.montage_images = False
+        self.image_manifest = manifest.load_manifest()
+        self.dedupe_near_images = False
+        self.image_dedupe = None
 
     def save_execution_times_to_excel(self):
-        self.df_execution_times.to_excel(self.time_file_name, index=False)
-        print(f"Execution times saved to {self.time_file_name}")
+        self.writer.flush()
+        self.execution_ledger.export_excel(self.time_file_name)
+        self.log_message(f"Execution times saved to {self.time_file_name}")
 
-    def log_message(self, message):
+    def log_message(self, message, level='info', **fields):
         print(message)
-        with open(self.log_file_path, "a") as log_file:
-            log_file.write(message + "\n")
+        self.run_log.log(level, message, **fields)
 
     def process_and_encode_image(self, image, resize_factor=0.9):
-        MAX_SIZE = 20 * 1024 * 1024  # 20MB
-        original_width, original_height = image.size
-
-        if image.mode == 'RGBA':
-            image = image.convert('RGB')
-
-        for attempt in range(5):
-            buffered = io.BytesIO()
-            new_width = int(original_width * (resize_factor ** attempt))
-            new_height = int(original_height * (resize_factor ** attempt))
-            resized_image = image.resize((new_width, new_height), Image.LANCZOS)
-            resized_image.save(buffered, format="JPEG")
-
-            if buffered.tell() < MAX_SIZE:
-                return base64.b64encode(buffered.getvalue()).decode("utf-8")
-            else:
-                print(f"Attempt {attempt + 1}: Image too large. Resizing...")
-
-        raise ValueError("Unable to reduce image size within 5 attempts")
+        return imaging.process_and_encode_image(
+            image, resize_factor, imaging.PROVIDER_PROFILES['openai']['max_bytes']
+        )
 
     def analyze_images_with_gpt4_vision(
         self, prompt_text, encoded_images, temperature=0
     ):
-        client = openai.OpenAI()
+        client = openai.OpenAI(**mock_server.client_kwargs('openai'))
         max_attempts = 10
 
         for attempt in range(max_attempts):
             try:
-                image_contents = [
-                    {
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/jpeg;base64,{img}"}
-                    } for img in encoded_images
-                ]
-                start_time = time.time()
-                response = client.chat.completions.create(
-                    model="gpt-4-turbo",
-                    response_format={"type": "json_object"},
-                    messages=[
+                with self.job_timer.stage('build'):
+                    image_contents = [
                         {
-                            "role": "user",
-                            "content": [
-                                {"type": "text", "text": prompt_text},
-                                *image_contents
-                            ]
-                        }
-                    ],
-                    max_tokens=1024,
-                    temperature=temperature,
-                )
+                            "type": "image_url",
+                            "image_url": {"url": f"data:image/jpeg;base64,{img}"}
+                        } for img in encoded_images
+                    ]
+                start_time = time.time()
+                with self.job_timer.stage('network', attempt=attempt + 1):
+                    response = self.cassette.call(
+                        'openai', client.chat.completions.create,
+                        model=self.model,
+                        response_format={"type": "json_object"},
+                        messages=[
+                            {
+                                "role": "user",
+                                "content": [
+                                    {"type": "text", "text": prompt_text},
+                                    *image_contents
+                                ]
+                            }
+                        ],
+                        max_tokens=1024,
+                        temperature=temperature,
+                    )
+                self.job_usage.add_response('openai', response)
                 response_result = response.choices[0]
 
                 if response_result.message.content.startswith("I'm sorry, but"):
-                    print(f"I'm sorry response. Retrying {attempt + 1}/{max_attempts}")
+                    self.log_message(
+                        f"I'm sorry response. Retrying {attempt + 1}/{max_attempts}", 'warning',
+                        reason='refusal', attempt=attempt + 1
+                    )
+                    self.job_timer.count('refusals')
                     continue
 
                 end_time = time.time()
                 execution_time = end_time - start_time
-                self.execution_times.append(execution_time)
+                self.latency_stats.add(self.model, temperature, execution_time)
 
-                self.print_execution_stats()
+                self.print_execution_stats(temperature)
 
                 return response_result
             except Exception as e:
-                print(f"BadRequestError: {e}")
+                self.log_message(
+                    f"BadRequestError: {e}", 'warning', error_class=type(e).__name__, attempt=attempt + 1
+                )
                 if "image_parse_error" in str(e).lower() and attempt < max_attempts - 1:
                     resized_encoded_images = []
                     for encoded_image in encoded_images:
                         image = Image.open(io.BytesIO(base64.b64decode(encoded_image)))
                         resized_image = self.process_and_encode_image(image, 0.9)
                         resized_encoded_images.append(resized_image)
-                    print(f"Resizing image and retrying {attempt + 1}/{max_attempts}")
+                    self.log_message(
+                        f"Resizing image and retrying {attempt + 1}/{max_attempts}",
+                        'warning', reason='image_retry', attempt=attempt + 1
+                    )
                     encoded_images = resized_encoded_images
 
         return None
 
-    def print_execution_stats(self):
-        avg_time = sum(self.execution_times) / len(self.execution_times)
-        max_time = max(self.execution_times)
-        min_time = min(self.execution_times)
-        std_dev = statistics.stdev(self.execution_times) if len(self.execution_times) > 1 else 0
-        total_points = len(self.execution_times)
-
-        print(f"Total data points: {total_points}")
-        print(f"Average execution time: {avg_time:.2f} seconds")
-        print(f"Max execution time: {max_time:.2f} seconds")
-        print(f"Min execution time: {min_time:.2f} seconds")
-        print(f"Standard deviation: {std_dev:.2f} seconds")
+    def print_execution_stats(self, temperature):
+        self.latency_stats.get(self.model, temperature).print_report()
 
     def read_text_file(self, file_path):
         with open(file_path, 'r') as file:
             return file.read()
 
     def encode_images_from_paths(self, image_paths):
-        images = []
+        usable_paths = []
         for image_path in image_paths:
-            if not os.path.exists(image_path):
-                print(f"Error: Image file does not exist: {image_path}")
+            entry = self.image_manifest.get(image_path)
+            if entry is None:
+                self.log_message(f"Error: Image file does not exist: {image_path}", 'error')
+                continue
+            if not self.image_manifest.is_large_enough(entry):
+                self.log_message(f"Image too small, skipping: {image_path}")
                 continue
+            usable_paths.append(image_path)
 
-            try:
-                with Image.open(image_path) as img:
-                    width, height = img.size
-                    if width > 150 and height > 150:
-                        encoded_image = self.process_and_encode_image(img)
-                        images.append(encoded_image)
-                        print(f"Successfully encoded image: {image_path}")
-                    else:
-                        print(f"Image too small, skipping: {image_path}")
-            except Exception as e:
-                print(f"Error processing image {image_path}: {e}")
+        images = []
+        encoded_images = imaging.encode_image_paths(
+            usable_paths, 'openai', self.crop_borders, return_exceptions=True
+        )
+        for image_path, encoded_image in zip(usable_paths, encoded_images):
+            if isinstance(encoded_image, Exception):
+                self.log_message(
+                    f"Error processing image {image_path}: {encoded_image}",
+                    'error', error_class=type(encoded_image).__name__
+                )
+            else:
+                images.append(encoded_image)
+                self.log_message(f"Successfully encoded image: {image_path}", 'debug')
         
         return images
 
+    def encode_montage_from_paths(self, image_paths):
+        encoded_montage = imaging.encode_montage(
+            image_paths, 'openai', self.crop_borders
+        )
+        if encoded_montage is None:
+            return self.encode_images_from_paths(image_paths)
+        return [encoded_montage]
+
     def create_result_folder(self, base_folder, temperature, try_number):
         folder_name = (
             f"{base_folder}_temp_{str(temperature).replace('.', '_')}"
@@ -173,29 +185,34 @@ class GPT4VisionAnalyzer:
         return folder_name
 
     def analyze_cases(self):
+        cases = case_sources.open_source(self.case_source, self.case_range)
+        # Built here rather than in __init__, so dedupe_near_images can still be set after construction.
+        self.image_dedupe = dedupe.load_index(self.image_manifest, self.dedupe_near_images)
+        prompt_store = prompts.build_store('orig', self.generate_prompt)
         for temperature in self.temperatures:
             for try_number in range(1, self.max_try + 1):
                 result_folder = self.create_result_folder(
                     self.base_result_folder, temperature, try_number
                 )
-                results_df = pd.DataFrame(
+                summary = self.writer.summary(
+                    result_folder,
                     columns=['case_number', 'answer', 'reason']
                 )
-                df = pd.read_excel('Lancet_QnA.xlsx')
 
                 current_dir = os.path.dirname(os.path.abspath(__file__))
                 parent_dir = os.path.dirname(current_dir)
                 case_folder = os.path.join(parent_dir, "Lancet_IMAGE240508")
 
-                for _, row in df.iterrows():
-                    case_number = row['no.']
-                    file_names = [
-                        file_name.strip() for file_name in str(row['jpg']).split(',')
-                    ]
+                for case in cases:
+                    case_number = case.number
+                    file_names = case.file_names
                     
-                    image_paths = self.get_image_paths(case_folder, file_names)
+                    self.job_timer = timing.JobTimer()
+                    self.job_usage = usage.JobUsage()
+                    with self.job_timer.stage('manifest'):
+                        image_paths = self.get_image_paths(case_folder, file_names)
 
-                    print("Filtered image paths:", image_paths)
+                    self.log_message(f"Filtered image paths: {image_paths}", 'debug', case_number=case_number)
 
                     directory_path = os.path.join(result_folder)
                     os.makedirs(directory_path, exist_ok=True)
@@ -203,64 +220,88 @@ class GPT4VisionAnalyzer:
                         directory_path, f"{case_number}.txt"
                     )
 
-                    if self.should_skip_case(case_number, temperature, try_number):
+                    prompt = prompt_store.get(case)
+                    job = self.job_key(prompt, image_paths, temperature, try_number)
+                    if self.should_skip_case(job, case_number, temperature, try_number):
                         continue
 
-                    symptom_text = f"symptom: {row['Q.']}"
-                    prompt_text = self.generate_prompt(symptom_text)
+                    prompt_text = prompt.text
 
-                    print(image_paths)
-                    encoded_images = self.encode_images_from_paths(image_paths)
+                    with self.job_timer.stage('encode'):
+                        if self.montage_images:
+                            encoded_images = self.encode_montage_from_paths(image_paths)
+                        else:
+                            encoded_images = self.encode_images_from_paths(image_paths)
+                    payload_bytes = sum(len(encoded_image) for encoded_image in encoded_images)
+                    self.job_usage.image_tokens_per_request = usage.image_tokens('openai', encoded_images)
 
+                    with self.job_timer.stage('backoff', reason='token_budget'):
+                        self.token_budget.acquire(prompt.tokens + self.job_usage.image_tokens_per_request)
                     start_time = time.time()
-                    result = self.analyze_images_with_gpt4_vision(
-                        prompt_text, encoded_images, temperature
-                    )
+                    with self.job_timer.stage('analyze', payload_bytes=payload_bytes):
+                        result = self.analyze_images_with_gpt4_vision(
+                            prompt_text, encoded_images, temperature
+                        )
                     end_time = time.time()
                     execution_time = end_time - start_time
 
-                    self.update_execution_times(
-                        case_number, temperature, try_number, execution_time
-                    )
-
                     if result:
-                        self.save_result(
-                            result, result_file_path, case_number,
-                            temperature, try_number
-                        )
-                        results_df = self.update_results_df(results_df, case_number, result)
+                        with self.job_timer.stage('persist'):
+                            self.save_result(
+                                result, job, result_file_path, case_number,
+                                temperature, try_number, execution_time
+                            )
+                        with self.job_timer.stage('parse'):
+                            self.add_summary_row(summary, case_number, result)
                     else:
-                        self.log_no_result(case_number, temperature, try_number)
+                        with self.job_timer.stage('persist'):
+                            self.log_no_result(job, result_file_path, case_number, temperature, try_number)
+
+                    self.token_budget.record(self.job_usage.total_tokens)
+                    outcome = 'ok' if result else 'no_result'
+                    self.metrics.observe_job(self.job_timer, outcome, payload_bytes, prompt.tokens, self.job_usage)
+                    self.tracer.export_job(
+                        self.job_timer, job, outcome, case_number=case_number, temperature=temperature,
+                        try_number=try_number, payload_bytes=payload_bytes
+                    )
+                    self.update_execution_times(
+                        case_number, temperature, try_number, execution_time,
+                        payload_bytes, job
+                    )
 
-                    self.save_results_to_excel(results_df, result_folder)
+                self.save_results_to_excel(summary)
 
         self.save_execution_times_to_excel()
 
     def get_image_paths(self, case_folder, file_names):
         image_paths = []
         for file_name in file_names:
-            file_path = None
-            if os.path.exists(os.path.join(case_folder, file_name)):
-                file_path = os.path.join(case_folder, file_name)
-            else:
-                for ext in self.image_extensions:
-                    potential_path = os.path.join(case_folder, f"{file_name}{ext}")
-                    if os.path.exists(potential_path):
-                        file_path = potential_path
-                        break
-            
+            file_path = self.image_manifest.resolve(file_name)
             if file_path:
                 image_paths.append(file_path)
             else:
-                print(f"Warning: Image file not found for {file_name} in {case_folder}")
+                self.log_message(f"Warning: Image file not found for {file_name} in {case_folder}", 'warning')
         return image_paths
 
-    def should_skip_case(self, case_number, temperature, try_number):
-        if ((self.df_execution_times['number'] == case_number) & 
-            (self.df_execution_times['temperature'] == temperature) & 
-            (self.df_execution_times['try'] == try_number)).any():
-            print(f"Case {case_number} (Temperature: {temperature}, "
-                  f"Try: {try_number}): skip")
+    def job_key(self, prompt, image_paths, temperature, try_number):
+        return jobs.job_key(
+            self.model, self.task, prompt.sha1,
+            jobs.image_set_digest(self.image_manifest, image_paths),
+            {
+                'temperature': temperature,
+                'try': try_number,
+                'crop_borders': self.crop_borders,
+                'montage_images': self.montage_images,
+                'dedupe_near_images': self.dedupe_near_images,
+            },
+        )
+
+    def should_skip_case(self, job, case_number, temperature, try_number):
+        if self.execution_ledger.has_job(job, case_number, temperature, try_number):
+            self.log_message(
+                f"Case {case_number} (Temperature: {temperature}, Try: {try_number}): skip",
+                job=job, case_number=case_number, temperature=temperature, try_number=try_number
+            )
             return True
         return False
 
@@ -282,57 +323,64 @@ class GPT4VisionAnalyzer:
                 """
 
     def update_execution_times(
-        self, case_number, temperature, try_number, execution_time
+        self, case_number, temperature, try_number, execution_time,
+        payload_bytes=None, job=None
     ):
-        new_row = pd.DataFrame({
-            'number': [case_number],
-            'temperature': [temperature],
-            'try': [try_number],
-            'time': [execution_time]
-        })
-        
-        existing_entry = (
-            (self.df_execution_times['number'] == case_number) & 
-            (self.df_execution_times['temperature'] == temperature) & 
-            (self.df_execution_times['try'] == try_number)
+        job_fields = self.job_timer.ledger_fields()
+        job_fields.update(self.job_usage.ledger_fields(self.model))
+        self.execution_ledger.record(
+            case_number, temperature, try_number, execution_time, payload_bytes, job=job, **job_fields
+        )
+        self.run_log.log(
+            'info', 'job finished', job=job, case_number=case_number, temperature=temperature,
+            try_number=try_number, execution_time=execution_time, payload_bytes=payload_bytes, **job_fields
         )
-        
-        if existing_entry.any():
-            self.df_execution_times.loc[existing_entry, 'time'] = execution_time
-        else:
-            # Ensure all columns are present in new_row
-            for col in self.df_execution_times.columns:
-                if col not in new_row.columns:
-                    new_row[col] = pd.NA
-            self.df_execution_times = pd.concat([self.df_execution_times, new_row], ignore_index=True)
 
     def save_result(
-        self, result, result_file_path, case_number, temperature, try_number
+        self, result, job, result_file_path, case_number, temperature,
+        try_number, execution_time=None
     ):
-        with open(result_file_path, "w") as result_file:
-            result_file.write(result.message.content)
-        print(f"Case {case_number} (Temperature: {temperature}, "
-            f"Try: {try_number}): Result saved.")
-
-    def update_results_df(self, results_df, case_number, result):
-        result_content = json.loads(result.message.content)
-        new_row = pd.DataFrame({
-            'case_number': [case_number],
-            'answer': [result_content['answer']],
-            'reason': [result_content['reason']]
-        })
-        return pd.concat([results_df, new_row], ignore_index=True)
-
-    def log_no_result(self, case_number, temperature, try_number):
+        self.result_store.put(
+            job, result_file_path, case_number, temperature, try_number,
+            result.message.content, latency=execution_time,
+            usage=self.job_usage.as_dict(self.model)
+        )
+        self.log_message(
+            f"Case {case_number} (Temperature: {temperature}, Try: {try_number}): Result saved.",
+            job=job, case_number=case_number, temperature=temperature, try_number=try_number
+        )
+
+    def add_summary_row(self, summary, case_number, result):
+        try:
+            result_content = json.loads(result.message.content)
+            row = {
+                'case_number': case_number,
+                'answer': result_content['answer'],
+                'reason': result_content['reason']
+            }
+        except (json.JSONDecodeError, KeyError, TypeError) as e:
+            self.job_timer.count('parse_failures')
+            self.log_message(
+                f"Failed to parse JSON result for case {case_number}: {e}", 'warning',
+                reason='parse_failure', error_class=type(e).__name__, case_number=case_number
+            )
+            return
+        summary.append(row)
+
+    def log_no_result(self, job, result_file_path, case_number, temperature, try_number):
+        self.result_store.put(
+            job, result_file_path, case_number, temperature, try_number,
+            None, status='no_result', usage=self.job_usage.as_dict(self.model)
+        )
         message = (f"Case {case_number} (Temperature: {temperature}, "
                    f"Try: {try_number}): No result found.")
-        print(message)
-        self.log_message(message)
+        self.log_message(
+            message, job=job, case_number=case_number, temperature=temperature, try_number=try_number
+        )
 
-    def save_results_to_excel(self, results_df, result_folder):
-        excel_path = os.path.join(result_folder, 'analysis_results.xlsx')
-        results_df.to_excel(excel_path, index=False)
-        print("Results have been saved to 'analysis_results.xlsx'.")
+    def save_results_to_excel(self, summary):
+        summary.close()
+        self.log_message(f"Results queued for {summary.excel_path}.")
 
 
 def main():
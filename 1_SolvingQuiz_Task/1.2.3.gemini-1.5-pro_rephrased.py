@@ -1,13 +1,16 @@
 import os
+import sys
 import json
-import io
-import base64
-from PIL import Image
 import time
-import pandas as pd
 import google.generativeai as genai
 from dotenv import load_dotenv
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lancet_vlm import (
+    case_sources, cassette, dedupe, imaging, jobs, ledger, logs, manifest, metrics, mock_server,
+    prompts, results, stats, timing, tracing, usage, writer,
+)
+
 parent_dir = os.path.dirname(os.getcwd())
 env_path = os.path.join(parent_dir, '.env')
 load_dotenv(env_path)
@@ -17,85 +20,71 @@ os.environ['GOOGLE_API_KEY'] = os.getenv("MY_GOOGLE_API_KEY")
 class GeminiVisionAnalyzer:
     def __init__(self, api_key, time_file_name="Gemini_rephrased_execution_times.xlsx"):
         self.api_key = api_key
-        self.execution_times = []
+        self.latency_stats = stats.LatencyBook()
+        self.job_timer = timing.JobTimer()
+        self.job_usage = usage.JobUsage()
         self.time_folder = 'time'
         os.makedirs(self.time_folder, exist_ok=True) 
         self.time_file_name = os.path.join(self.time_folder, time_file_name)
-        self.df_execution_times = self.load_or_initialize_execution_times()
-        self.log_file_path = os.path.join("./", "process_log.txt")
+        self.model = "gemini-1.5-pro"
+        self.task = "1_rephrased"
+        self.metrics = metrics.open_metrics('gemini', self.model, self.task)
+        self.writer = writer.BackgroundWriter()
+        self.execution_ledger = ledger.open_ledger(
+            self.time_file_name, self.writer, jobs.namespace(self.model, self.task)
+        )
+        self.result_store = results.open_store(writer=self.writer)
+        self.run_log = logs.open_run_log(self.model, self.task)
+        self.tracer = tracing.open_tracer(self.model, self.task, self.writer, self.run_log.run_id)
+        self.cassette = cassette.open_cassette(self.model, self.task, self.writer)
+        self.token_budget = usage.open_budget()
         self.temperatures = [0, 0.5, 1]
         self.base_result_folder = "gemini_rephrased_result/gemini_rephrased_result"
         self.max_try = 5
-        self.image_extensions = ['.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.gif']
+        self.case_source = None
+        self.case_range = None
+        self.crop_borders = False
+        self.montage_images = False
+        self.skip_small_images = False
+        self.image_manifest = manifest.load_manifest()
+        self.dedupe_near_images = False
+        self.image_dedupe = None
         
-        genai.configure(api_key=self.api_key)
-
-    def load_or_initialize_execution_times(self):
-        if os.path.exists(self.time_file_name):
-            print("Loading time file")
-            return pd.read_excel(self.time_file_name)
-        else:
-            print("Creating time file")
-            return pd.DataFrame({
-                'number': pd.Series(dtype='int'),
-                'temperature': pd.Series(dtype='float'),
-                'try': pd.Series(dtype='int'),
-                'time': pd.Series(dtype='float')
-            })
-    
+        genai.configure(api_key=self.api_key, **mock_server.client_kwargs('gemini'))
+
     def get_image_paths(self, case_folder, file_names):
         image_paths = []
         for file_name in file_names:
-            file_path = None
-            if os.path.exists(os.path.join(case_folder, file_name)):
-                file_path = os.path.join(case_folder, file_name)
-            else:
-                for ext in self.image_extensions:
-                    potential_path = os.path.join(case_folder, f"{file_name}{ext}")
-                    if os.path.exists(potential_path):
-                        file_path = potential_path
-                        break
-            
+            file_path = self.image_manifest.resolve(file_name)
             if file_path:
                 image_paths.append(file_path)
             else:
-                print(f"Warning: Image file not found for {file_name} in {case_folder}")
+                self.log_message(f"Warning: Image file not found for {file_name} in {case_folder}", 'warning')
         return image_paths
 
     def save_execution_times_to_excel(self):
+        self.writer.flush()
         try:
-            self.df_execution_times.to_excel(self.time_file_name, index=False)
-            print(f"Execution times saved to {self.time_file_name}")
+            self.execution_ledger.export_excel(self.time_file_name)
+            self.log_message(f"Execution times saved to {self.time_file_name}")
         except OSError as e:
-            print(f"Error: Failed to save execution times - {str(e)}")
+            self.log_message(
+                f"Error: Failed to save execution times - {str(e)}", 'error', error_class=type(e).__name__
+            )
         except Exception as e:
-            print(f"Error: An unexpected error occurred while saving execution times - {str(e)}")
+            self.log_message(
+                f"Error: An unexpected error occurred while saving execution times - {str(e)}",
+                'error', error_class=type(e).__name__
+            )
 
-    def log_message(self, message):
+    def log_message(self, message, level='info', **fields):
         print(message)
-        with open(self.log_file_path, "a") as log_file:
-            log_file.write(message + "\n")
+        self.run_log.log(level, message, **fields)
 
     def process_and_encode_image(self, image, resize_factor=0.9):
-        MAX_SIZE = 20 * 1024 * 1024  # 20MB
-        original_width, original_height = image.size
-
-        if image.mode == 'RGBA':
-            image = image.convert('RGB')
-
-        for attempt in range(5):
-            buffered = io.BytesIO()
-            new_width = int(original_width * (resize_factor ** attempt))
-            new_height = int(original_height * (resize_factor ** attempt))
-            resized_image = image.resize((new_width, new_height), Image.LANCZOS)
-            resized_image.save(buffered, format="JPEG")
-
-            if buffered.tell() < MAX_SIZE:
-                return base64.b64encode(buffered.getvalue()).decode("utf-8")
-            else:
-                print(f"Attempt {attempt + 1}: Image too large. Resizing...")
-
-        raise ValueError("Unable to reduce image size within 5 attempts")
+        return imaging.process_and_encode_image(
+            image, resize_factor, imaging.PROVIDER_PROFILES['gemini']['max_bytes']
+        )
     
     def extract_json_from_response(self, response):
         try:
@@ -104,126 +93,205 @@ class GeminiVisionAnalyzer:
             json_str = response[start:end]
             return json.loads(json_str)
         except (ValueError, json.JSONDecodeError):
-            print(f"Failed to extract JSON from response: {response}")
+            self.log_message(
+                f"Failed to extract JSON from response: {response}", 'debug', reason='parse_failure'
+            )
             return None
 
-    def analyze_images_with_gemini_vision(self, prompt_text, image_paths, temperature=0):
+    def analyze_images_with_gemini_vision(self, prompt_text, encoded_images, temperature=0):
         generation_config = {"temperature": temperature}
-        model = genai.GenerativeModel(model_name="gemini-1.5-pro", generation_config=generation_config)
+        model = genai.GenerativeModel(model_name=self.model, generation_config=generation_config)
         chat_session = model.start_chat()
 
-        images = []
-        for path in image_paths:
-            try:
-                img = Image.open(path)
-                images.append(img)
-            except IOError:
-                print(f"Error: Failed to open image file: {path}")
+        with self.job_timer.stage('build'):
+            images = [imaging.inline_image_part(encoded_image) for encoded_image in encoded_images]
 
-        message_contents = [prompt_text] + images
+            message_contents = [prompt_text] + images
 
         max_attempts = 10
         for attempt in range(max_attempts):
             try:
                 start_time = time.time()
-                response = chat_session.send_message(message_contents)
+                with self.job_timer.stage('network', attempt=attempt + 1):
+                    response = self.cassette.call(
+                        'gemini', chat_session.send_message, message_contents,
+                        context={'model': self.model, 'generation_config': generation_config}
+                    )
+                self.job_usage.add_response('gemini', response)
                 end_time = time.time()
 
                 execution_time = end_time - start_time
 
                 if not response.text.strip():
+                    self.job_timer.count('empty_responses')
                     continue
 
-                result = self.extract_json_from_response(response.text)
+                with self.job_timer.stage('parse'):
+                    result = self.extract_json_from_response(response.text)
                 if result:
+                    self.latency_stats.add(self.model, temperature, execution_time)
+                    self.print_execution_stats(temperature)
                     return result, execution_time
                 else:
-                    print(f"Failed to extract JSON from response. Attempt {attempt + 1}")
+                    self.job_timer.count('parse_failures')
+                    self.log_message(
+                        f"Failed to extract JSON from response. Attempt {attempt + 1}", 'warning',
+                        reason='parse_failure', attempt=attempt + 1
+                    )
 
             except Exception as e:
-                print(f"Error: API request failed - {str(e)}")
+                self.log_message(
+                    f"Error: API request failed - {str(e)}", 'warning',
+                    error_class=type(e).__name__, attempt=attempt + 1
+                )
                 if "429" in str(e):
                     wait_time = 2 ** attempt  
-                    print(f"Error: API rate limit reached. Retrying in {wait_time} seconds.")
-                    time.sleep(wait_time)
+                    self.log_message(
+                        f"Error: API rate limit reached. Retrying in {wait_time} seconds.", 'warning',
+                        reason='rate_limit', backoff=wait_time, attempt=attempt + 1
+                    )
+                    with self.job_timer.stage('backoff'):
+                        time.sleep(wait_time)
                 else:
                     continue
         return None, None
 
+    def print_execution_stats(self, temperature):
+        self.latency_stats.get(self.model, temperature).print_report()
+
     def encode_images_from_paths(self, image_paths):
-        images = []
+        usable_paths = []
         for image_path in image_paths:
-            if not os.path.exists(image_path):
-                print(f"Error: Image file does not exist: {image_path}")
+            entry = self.image_manifest.get(image_path)
+            if entry is None:
+                self.log_message(f"Error: Image file does not exist: {image_path}", 'error')
+                continue
+            if self.skip_small_images and not self.image_manifest.is_large_enough(entry):
+                self.log_message(f"Image too small, skipping: {image_path}")
                 continue
+            usable_paths.append(image_path)
 
-            try:
-                with Image.open(image_path) as img:
-                    width, height = img.size
-                    if width > 150 and height > 150:
-                        encoded_image = self.process_and_encode_image(img)
-                        images.append(encoded_image)
-                        print(f"Successfully encoded image: {image_path}")
-                    else:
-                        print(f"Image too small, skipping: {image_path}")
-            except Exception as e:
-                print(f"Error processing image {image_path}: {e}")
+        images = []
+        encoded_images = imaging.encode_image_paths(
+            usable_paths, 'gemini', self.crop_borders, return_exceptions=True
+        )
+        for image_path, encoded_image in zip(usable_paths, encoded_images):
+            if isinstance(encoded_image, Exception):
+                self.log_message(
+                    f"Error processing image {image_path}: {encoded_image}",
+                    'error', error_class=type(encoded_image).__name__
+                )
+            else:
+                images.append(encoded_image)
+                self.log_message(f"Successfully encoded image: {image_path}", 'debug')
         
         return images
 
+    def encode_montage_from_paths(self, image_paths):
+        encoded_montage = imaging.encode_montage(
+            image_paths, 'gemini', self.crop_borders
+        )
+        if encoded_montage is None:
+            return self.encode_images_from_paths(image_paths)
+        return [encoded_montage]
+
     def create_result_folder(self, base_folder, temperature, try_number):
         folder_name = f"{base_folder}_temp_{str(temperature).replace('.', '_')}_try{try_number}"
         os.makedirs(folder_name, exist_ok=True)
         return folder_name
 
     def analyze_cases(self):
+        cases = case_sources.open_source(self.case_source, self.case_range)
+        # Built here rather than in __init__, so dedupe_near_images can still be set after construction.
+        self.image_dedupe = dedupe.load_index(self.image_manifest, self.dedupe_near_images)
+        prompt_store = prompts.build_store('rephrased', self.generate_prompt)
         for temperature in self.temperatures:
             for try_number in range(1, self.max_try + 1):
                 result_folder = self.create_result_folder(self.base_result_folder, temperature, try_number)
-                results_df = pd.DataFrame(columns=['case_number', 'answer', 'reason'])
-                df = pd.read_excel('Lancet_QnA.xlsx')
+                summary = self.writer.summary(result_folder, columns=['case_number', 'answer', 'reason'])
 
                 current_dir = os.path.dirname(os.path.abspath(__file__))
                 parent_dir = os.path.dirname(current_dir)
                 case_folder = os.path.join(parent_dir, "Lancet_IMAGE240508")
 
-                for _, row in df.iterrows():
-                    case_number = row['no.']
-                    file_names = [file_name.strip() for file_name in str(row['jpg']).split(',')]
-                    image_paths = self.get_image_paths(case_folder, file_names)
-                    print("Filtered image paths:", image_paths)
+                for case in cases:
+                    case_number = case.number
+                    file_names = case.file_names
+                    self.job_timer = timing.JobTimer()
+                    self.job_usage = usage.JobUsage()
+                    with self.job_timer.stage('manifest'):
+                        image_paths = self.get_image_paths(case_folder, file_names)
+                    self.log_message(f"Filtered image paths: {image_paths}", 'debug', case_number=case_number)
 
                     directory_path = os.path.join(result_folder)
                     os.makedirs(directory_path, exist_ok=True)
                     result_file_path = os.path.join(directory_path, f"{case_number}.txt")
 
-                    if self.should_skip_case(case_number, temperature, try_number):
+                    prompt = prompt_store.get(case)
+                    job = self.job_key(prompt, image_paths, temperature, try_number)
+                    if self.should_skip_case(job, case_number, temperature, try_number):
                         continue
 
-                    symptom_text = f"symptom: {row['new_q']} {row['new_c']}"
-                    prompt_text = self.generate_prompt(symptom_text)
+                    prompt_text = prompt.text
 
-                    print(image_paths)
-                    result, execution_time = self.analyze_images_with_gemini_vision(prompt_text, image_paths, temperature)
+                    with self.job_timer.stage('encode'):
+                        if self.montage_images:
+                            encoded_images = self.encode_montage_from_paths(image_paths)
+                        else:
+                            encoded_images = self.encode_images_from_paths(image_paths)
+                    payload_bytes = sum(len(encoded_image) for encoded_image in encoded_images)
+                    self.job_usage.image_tokens_per_request = usage.image_tokens('gemini', encoded_images)
 
-                    self.update_execution_times(case_number, temperature, try_number, execution_time)
+                    with self.job_timer.stage('backoff', reason='token_budget'):
+                        self.token_budget.acquire(prompt.tokens + self.job_usage.image_tokens_per_request)
+                    with self.job_timer.stage('analyze', payload_bytes=payload_bytes):
+                        result, execution_time = self.analyze_images_with_gemini_vision(prompt_text, encoded_images, temperature)
 
                     if result is not None:
-                        self.save_result(result, result_file_path, case_number, temperature, try_number)
-                        results_df = self.update_results_df(results_df, case_number, result)
+                        with self.job_timer.stage('persist'):
+                            self.save_result(
+                                result, job, result_file_path, case_number, temperature, try_number,
+                                execution_time
+                            )
+                        with self.job_timer.stage('parse'):
+                            self.add_summary_row(summary, case_number, result)
                     else:
-                        self.log_no_result(case_number, temperature, try_number)
+                        with self.job_timer.stage('persist'):
+                            self.log_no_result(job, result_file_path, case_number, temperature, try_number)
+
+                    self.token_budget.record(self.job_usage.total_tokens)
+                    outcome = 'ok' if result is not None else 'no_result'
+                    self.metrics.observe_job(self.job_timer, outcome, payload_bytes, prompt.tokens, self.job_usage)
+                    self.tracer.export_job(
+                        self.job_timer, job, outcome, case_number=case_number, temperature=temperature,
+                        try_number=try_number, payload_bytes=payload_bytes
+                    )
+                    self.update_execution_times(case_number, temperature, try_number, execution_time, payload_bytes, job)
 
-                self.save_results_to_excel(results_df, result_folder)
+                self.save_results_to_excel(summary)
 
         self.save_execution_times_to_excel()
 
-    def should_skip_case(self, case_number, temperature, try_number):
-        if ((self.df_execution_times['number'] == case_number) &
-            (self.df_execution_times['temperature'] == temperature) &
-            (self.df_execution_times['try'] == try_number) &
-            self.df_execution_times['time'].notna()).any():
-            print(f"Case {case_number} (Temperature: {temperature}, Try: {try_number}): skip")
+    def job_key(self, prompt, image_paths, temperature, try_number):
+        return jobs.job_key(
+            self.model, self.task, prompt.sha1,
+            jobs.image_set_digest(self.image_manifest, image_paths),
+            {
+                'temperature': temperature,
+                'try': try_number,
+                'crop_borders': self.crop_borders,
+                'montage_images': self.montage_images,
+                'skip_small_images': self.skip_small_images,
+                'dedupe_near_images': self.dedupe_near_images,
+            },
+        )
+
+    def should_skip_case(self, job, case_number, temperature, try_number):
+        if self.execution_ledger.has_job(job, case_number, temperature, try_number, timed=True):
+            self.log_message(
+                f"Case {case_number} (Temperature: {temperature}, Try: {try_number}): skip",
+                job=job, case_number=case_number, temperature=temperature, try_number=try_number
+            )
             return True
         return False
 
@@ -247,60 +315,63 @@ class GeminiVisionAnalyzer:
         Ensure that your entire response is valid JSON. Do not include any text before or after the JSON object.
         """
 
-    def update_execution_times(self, case_number, temperature, try_number, execution_time):
-        new_row = pd.DataFrame({
-            'number': [case_number],
-            'temperature': [temperature],
-            'try': [try_number],
-            'time': [execution_time]
-        })
-        
-        existing_entry = (
-            (self.df_execution_times['number'] == case_number) & 
-            (self.df_execution_times['temperature'] == temperature) & 
-            (self.df_execution_times['try'] == try_number)
+    def update_execution_times(self, case_number, temperature, try_number, execution_time, payload_bytes=None, job=None):
+        job_fields = self.job_timer.ledger_fields()
+        job_fields.update(self.job_usage.ledger_fields(self.model))
+        self.execution_ledger.record(
+            case_number, temperature, try_number, execution_time, payload_bytes, job=job, **job_fields
+        )
+        self.run_log.log(
+            'info', 'job finished', job=job, case_number=case_number, temperature=temperature,
+            try_number=try_number, execution_time=execution_time, payload_bytes=payload_bytes, **job_fields
         )
-        
-        if existing_entry.any():
-            self.df_execution_times.loc[existing_entry, 'time'] = execution_time
-        else:
-            self.df_execution_times = pd.concat([self.df_execution_times, new_row], ignore_index=True, sort=False)
 
-    def save_result(self, result, result_file_path, case_number, temperature, try_number):
-        with open(result_file_path, "w") as result_file:
-            if isinstance(result, dict):
-                json.dump(result, result_file, indent=2)
-            else:
-                result_file.write(str(result))
-        print(f"Gemini Case {case_number} (Temperature: {temperature}, Try: {try_number}): Result saved.")
+    def save_result(self, result, job, result_file_path, case_number, temperature, try_number,
+                    execution_time=None):
+        raw = json.dumps(result, indent=2) if isinstance(result, dict) else str(result)
+        self.result_store.put(
+            job, result_file_path, case_number, temperature, try_number,
+            raw, latency=execution_time,
+            usage=self.job_usage.as_dict(self.model)
+        )
+        self.log_message(
+            f"Gemini Case {case_number} (Temperature: {temperature}, Try: {try_number}): Result saved.",
+            job=job, case_number=case_number, temperature=temperature, try_number=try_number
+        )
 
-    def update_results_df(self, results_df, case_number, result):
+    def add_summary_row(self, summary, case_number, result):
         try:
             if isinstance(result, dict):
                 result_content = result
             else:
                 result_content = json.loads(result)
             
-            new_row = pd.DataFrame({
-                'case_number': [case_number],
-                'answer': [result_content.get('answer', '')],
-                'reason': [result_content.get('reason', '')]
+            summary.append({
+                'case_number': case_number,
+                'answer': result_content.get('answer', ''),
+                'reason': result_content.get('reason', '')
             })
-            return pd.concat([results_df, new_row], ignore_index=True)
-        except (json.JSONDecodeError, TypeError):
-            print(f"Error: Unable to process result for case {case_number}")
-            print(f"Raw result: {result}")
-            return results_df
-
-    def log_no_result(self, case_number, temperature, try_number):
+        except (json.JSONDecodeError, TypeError) as e:
+            self.job_timer.count('parse_failures')
+            self.log_message(
+                f"Error: Unable to process result for case {case_number} - {e}", 'warning',
+                reason='parse_failure', error_class=type(e).__name__, case_number=case_number,
+                raw_result=str(result)
+            )
+
+    def log_no_result(self, job, result_file_path, case_number, temperature, try_number):
+        self.result_store.put(
+            job, result_file_path, case_number, temperature, try_number,
+            None, status='no_result', usage=self.job_usage.as_dict(self.model)
+        )
         message = f"Gemini Case {case_number} (Temperature: {temperature}, Try: {try_number}): No result found."
-        print(message)
-        self.log_message(message)
+        self.log_message(
+            message, job=job, case_number=case_number, temperature=temperature, try_number=try_number
+        )
 
-    def save_results_to_excel(self, results_df, result_folder):
-        excel_path = os.path.join(result_folder, 'analysis_results.xlsx')
-        results_df.to_excel(excel_path, index=False)
-        print("Results have been saved to 'analysis_results.xlsx'.")
+    def save_results_to_excel(self, summary):
+        summary.close()
+        self.log_message(f"Results queued for {summary.excel_path}.")
 
 def main():
     api_key = os.getenv("GOOGLE_API_KEY")
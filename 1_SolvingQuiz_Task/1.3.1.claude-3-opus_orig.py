@@ -1,14 +1,19 @@
 import anthropic
 import base64
 import io
+import json
 import os
-import pandas as pd
-import statistics
 import sys
 import time
 from PIL import Image
 from dotenv import load_dotenv
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lancet_vlm import (
+    case_sources, cassette, dedupe, imaging, jobs, ledger, logs, manifest, metrics, mock_server,
+    prompts, results, stats, timing, tracing, usage, writer,
+)
+
 parent_dir = os.path.dirname(os.getcwd())
 env_path = os.path.join(parent_dir, '.env')
 load_dotenv(env_path)
@@ -17,113 +22,121 @@ os.environ['ANTHROPIC_API_KEY'] = os.getenv("MY_ANTHROPIC_API_KEY")
 
 class ClaudeVisionAnalyzer:
     def __init__(self, api_key, time_file_name="Claude_execution_times.xlsx"):
-        self.client = anthropic.Anthropic(api_key=api_key)
-        self.execution_times = []
+        self.client = anthropic.Anthropic(api_key=api_key, **mock_server.client_kwargs('anthropic'))
+        self.latency_stats = stats.LatencyBook()
+        self.job_timer = timing.JobTimer()
+        self.job_usage = usage.JobUsage()
         self.time_file_name = os.path.join('time', time_file_name)
-        self.df_execution_times = self.load_or_initialize_execution_times()
-        self.log_file_path = os.path.join("./", "process_log.txt")
+        self.model = "claude-3-opus-20240229"
+        self.task = "1_orig"
+        self.metrics = metrics.open_metrics('anthropic', self.model, self.task)
+        self.writer = writer.BackgroundWriter()
+        self.execution_ledger = ledger.open_ledger(
+            self.time_file_name, self.writer, jobs.namespace(self.model, self.task)
+        )
+        self.result_store = results.open_store(writer=self.writer)
+        self.run_log = logs.open_run_log(self.model, self.task)
+        self.tracer = tracing.open_tracer(self.model, self.task, self.writer, self.run_log.run_id)
+        self.cassette = cassette.open_cassette(self.model, self.task, self.writer)
+        self.token_budget = usage.open_budget()
         self.temperatures = [0, 0.5, 1]
         self.base_result_folder = "Claude_result/Claude_result"
         self.max_try = 5
+        self.case_source = None
+        self.case_range = None
+        self.crop_borders = False
+        self.montage_images = False
+        self.static_prefix = ''
+        self.cache_case_prefix = True
         
         current_dir = os.path.dirname(os.path.abspath(__file__))
         parent_dir = os.path.dirname(current_dir)
         self.case_folder = os.path.join(parent_dir, "Lancet_IMAGE240508")
-
-    def load_or_initialize_execution_times(self):
-        if os.path.exists(self.time_file_name):
-            print("Loading time file")
-            return pd.read_excel(self.time_file_name)
-        else:
-            print("Creating time file")
-            return pd.DataFrame({
-                'number': pd.Series(dtype='int'),
-                'temperature': pd.Series(dtype='float'),
-                'try': pd.Series(dtype='int'),
-                'time': pd.Series(dtype='float')
-            })
+        self.image_manifest = manifest.load_manifest(self.case_folder)
+        self.dedupe_near_images = False
+        self.image_dedupe = None
 
     def save_execution_times_to_excel(self):
-        self.df_execution_times.to_excel(self.time_file_name, index=False)
-        print(f"Execution times saved to {self.time_file_name}")
+        self.writer.flush()
+        self.execution_ledger.export_excel(self.time_file_name)
+        self.log_message(f"Execution times saved to {self.time_file_name}")
 
-    def log_message(self, message):
+    def log_message(self, message, level='info', **fields):
         print(message)
-        with open(self.log_file_path, "a") as log_file:
-            log_file.write(message + "\n")
+        self.run_log.log(level, message, **fields)
 
     def process_and_encode_image(self, image, resize_factor=0.9):
-        MAX_SIZE = 20 * 1024 * 1024  # 20MB
-        original_width, original_height = image.size
-
-        if image.mode == 'RGBA':
-            image = image.convert('RGB')
-
-        for attempt in range(5):
-            buffered = io.BytesIO()
-            new_width = int(original_width * (resize_factor ** attempt))
-            new_height = int(original_height * (resize_factor ** attempt))
-            resized_image = image.resize((new_width, new_height), Image.LANCZOS)
-            resized_image.save(buffered, format="JPEG")
-
-            if buffered.tell() < MAX_SIZE:
-                return base64.b64encode(buffered.getvalue()).decode("utf-8")
-            else:
-                print(f"Attempt {attempt + 1}: Image size is {buffered.tell()} bytes, too large. Resizing...")
-
-        raise ValueError("Unable to reduce image size within 5 attempts")
+        return imaging.process_and_encode_image(
+            image, resize_factor, imaging.PROVIDER_PROFILES['anthropic']['max_bytes']
+        )
 
     def analyze_images_with_Claude_vision(self, prompt_text, encoded_images, temperature=0):
         max_attempts = 10
         for attempt in range(max_attempts):
             try:
-                image_contents = [
-                    {
-                        "type": "image",
-                        "source": {
-                            "type": "base64",
-                            "media_type": "image/jpeg",
-                            "data": encoded_image
-                        }
-                    } for encoded_image in encoded_images
-                ]
-                start_time = time.time()
-                response = self.client.messages.create(
-                    model="claude-3-opus-20240229",
-                    messages=[
+                with self.job_timer.stage('build'):
+                    image_contents = [
                         {
-                            "role": "user",
-                            "content": [
-                                {"type": "text", "text": prompt_text},
-                                *image_contents
-                            ],
-                        }
-                    ],
-                    max_tokens=1024,
-                    temperature=temperature,
-                )
+                            "type": "image",
+                            "source": {
+                                "type": "base64",
+                                "media_type": "image/jpeg",
+                                "data": encoded_image
+                            }
+                        } for encoded_image in encoded_images
+                    ]
+                    content = [
+                        *prompts.cached_text_blocks(prompt_text, self.static_prefix),
+                        *image_contents
+                    ]
+                    case_tokens = prompts.estimate_tokens(prompt_text) + self.job_usage.image_tokens_per_request
+                    if self.cache_case_prefix and case_tokens >= prompts.ANTHROPIC_MIN_CACHE_TOKENS:
+                        content[-1] = dict(content[-1], cache_control={"type": "ephemeral"})
+                start_time = time.time()
+                with self.job_timer.stage('network', attempt=attempt + 1):
+                    response = self.cassette.call(
+                        'anthropic', self.client.messages.create,
+                        model=self.model,
+                        messages=[
+                            {
+                                "role": "user",
+                                "content": content,
+                            }
+                        ],
+                        max_tokens=1024,
+                        temperature=temperature,
+                        extra_headers=prompts.cache_headers(content),
+                    )
+                self.job_usage.add_response('anthropic', response)
                 response_result = response
 
                 if response_result.content[0].text.startswith("I'm sorry, but"):
-                    print(f"Response starts with 'I'm sorry', retrying. Attempt {attempt + 1}/{max_attempts}")
+                    self.log_message(
+                        f"Response starts with 'I'm sorry', retrying. Attempt {attempt + 1}/{max_attempts}",
+                        'warning', reason='refusal', attempt=attempt + 1
+                    )
+                    self.job_timer.count('refusals')
                     continue
 
                 end_time = time.time()
                 execution_time = end_time - start_time
-                self.execution_times.append(execution_time)
+                self.latency_stats.add(self.model, temperature, execution_time)
 
-                self.print_execution_stats()
+                self.print_execution_stats(temperature)
 
                 return response_result.content[0].text
             except Exception as e:
-                print(f"Error: {e}")
+                self.log_message(f"Error: {e}", 'warning', error_class=type(e).__name__, attempt=attempt + 1)
                 if "image_parse_error" in str(e).lower() and attempt < max_attempts - 1:
                     resized_encoded_images = []
                     for encoded_image in encoded_images:
                         image = Image.open(io.BytesIO(base64.b64decode(encoded_image)))
                         resized_image = self.process_and_encode_image(image, 0.9)
                         resized_encoded_images.append(resized_image)
-                    print(f"Adjusting image resolution and retrying. Attempt {attempt + 1}/{max_attempts}")
+                    self.log_message(
+                        f"Adjusting image resolution and retrying. Attempt {attempt + 1}/{max_attempts}",
+                        'warning', reason='image_retry', attempt=attempt + 1
+                    )
                     encoded_images = resized_encoded_images
                 elif "exceeded" in str(e).lower():
                     self.save_execution_times_to_excel()
@@ -131,28 +144,24 @@ class ClaudeVisionAnalyzer:
 
         return None
 
-    def print_execution_stats(self):
-        total_data_points = len(self.execution_times)
-        average_time = sum(self.execution_times) / total_data_points
-        max_time = max(self.execution_times)
-        min_time = min(self.execution_times)
-        std_dev = statistics.stdev(self.execution_times) if total_data_points > 1 else 0
-
-        print(f"Total number of data points: {total_data_points}")
-        print(f"Average execution time: {average_time:.2f} seconds")
-        print(f"Maximum execution time: {max_time:.2f} seconds")
-        print(f"Minimum execution time: {min_time:.2f} seconds")
-        print(f"Standard deviation: {std_dev:.2f} seconds")
+    def print_execution_stats(self, temperature):
+        self.latency_stats.get(self.model, temperature).print_report()
 
     def encode_images_from_paths(self, image_paths):
-        images = []
+        usable_paths = []
         for image_path in image_paths:
-            with Image.open(image_path) as img:
-                width, height = img.size
-                if width > 150 and height > 150:
-                    encoded_image = self.process_and_encode_image(img)
-                    images.append(encoded_image)
-        return images
+            entry = self.image_manifest.get(image_path)
+            if entry is not None and self.image_manifest.is_large_enough(entry):
+                usable_paths.append(image_path)
+        return imaging.encode_image_paths(usable_paths, 'anthropic', self.crop_borders)
+
+    def encode_montage_from_paths(self, image_paths):
+        encoded_montage = imaging.encode_montage(
+            image_paths, 'anthropic', self.crop_borders
+        )
+        if encoded_montage is None:
+            return self.encode_images_from_paths(image_paths)
+        return [encoded_montage]
 
     def create_result_folder(self, base_folder, temperature, try_number):
         folder_name = f"{base_folder}_temp_{str(temperature).replace('.', '_')}_try{try_number}"
@@ -160,48 +169,105 @@ class ClaudeVisionAnalyzer:
         return folder_name
 
     def analyze_cases(self):
+        cases = case_sources.open_source(self.case_source, self.case_range)
+        # Built here rather than in __init__, so dedupe_near_images can still be set after construction.
+        self.image_dedupe = dedupe.load_index(self.image_manifest, self.dedupe_near_images)
+        prompt_store = prompts.build_store('orig', self.generate_prompt)
+        self.static_prefix = prompt_store.static_prefix
         for temperature in self.temperatures:
             for try_number in range(1, self.max_try+1):
                 result_folder = self.create_result_folder(self.base_result_folder, temperature, try_number)
-                df = pd.read_excel('Lancet_QnA.xlsx')
 
-                for _, row in df.iterrows():
-                    case_number = row['no.']
-                    file_names = [f"{file_name.strip()}.jpg" for file_name in str(row['jpg']).split(',')]
-                    image_paths = [os.path.join(self.case_folder, file_name) for file_name in file_names]
-                    print("Filtered image paths:", image_paths)
+                for case in cases:
+                    case_number = case.number
+                    file_names = case.file_names
+                    self.job_timer = timing.JobTimer()
+                    self.job_usage = usage.JobUsage()
+                    with self.job_timer.stage('manifest'):
+                        image_paths = self.get_image_paths(file_names)
+                    self.log_message(f"Filtered image paths: {image_paths}", 'debug', case_number=case_number)
 
                     directory_path = os.path.join(result_folder)
                     os.makedirs(directory_path, exist_ok=True)
                     result_file_path = os.path.join(directory_path, f"{case_number}.txt")
 
-                    if self.should_skip_case(case_number, temperature, try_number):
+                    prompt = prompt_store.get(case)
+                    job = self.job_key(prompt, image_paths, temperature, try_number)
+                    if self.should_skip_case(job, case_number, temperature, try_number):
                         continue
 
-                    symptom_text = f"symptom: {row['Q.']}"
-                    prompt_text = self.generate_prompt(symptom_text)
+                    prompt_text = prompt.text
 
-                    encoded_images = self.encode_images_from_paths(image_paths)
+                    with self.job_timer.stage('encode'):
+                        if self.montage_images:
+                            encoded_images = self.encode_montage_from_paths(image_paths)
+                        else:
+                            encoded_images = self.encode_images_from_paths(image_paths)
+                    payload_bytes = sum(len(encoded_image) for encoded_image in encoded_images)
+                    self.job_usage.image_tokens_per_request = usage.image_tokens('anthropic', encoded_images)
 
+                    with self.job_timer.stage('backoff', reason='token_budget'):
+                        self.token_budget.acquire(prompt.tokens + self.job_usage.image_tokens_per_request)
                     start_time = time.time()
-                    result = self.analyze_images_with_Claude_vision(prompt_text, encoded_images, temperature)
+                    with self.job_timer.stage('analyze', payload_bytes=payload_bytes):
+                        result = self.analyze_images_with_Claude_vision(prompt_text, encoded_images, temperature)
                     end_time = time.time()
                     execution_time = end_time - start_time
 
-                    self.update_execution_times(case_number, temperature, try_number, execution_time)
-
                     if result:
-                        self.save_result(result, result_file_path, case_number, temperature, try_number)
+                        with self.job_timer.stage('persist'):
+                            self.save_result(
+                                result, job, result_file_path, case_number, temperature, try_number,
+                                execution_time
+                            )
+                        with self.job_timer.stage('parse'):
+                            self.check_result_json(case_number, result)
                     else:
-                        self.log_no_result(case_number, temperature, try_number)
+                        with self.job_timer.stage('persist'):
+                            self.log_no_result(job, result_file_path, case_number, temperature, try_number)
+
+                    self.token_budget.record(self.job_usage.total_tokens)
+                    outcome = 'ok' if result else 'no_result'
+                    self.metrics.observe_job(self.job_timer, outcome, payload_bytes, prompt.tokens, self.job_usage)
+                    self.tracer.export_job(
+                        self.job_timer, job, outcome, case_number=case_number, temperature=temperature,
+                        try_number=try_number, payload_bytes=payload_bytes
+                    )
+                    self.update_execution_times(case_number, temperature, try_number, execution_time, payload_bytes, job)
 
         self.save_execution_times_to_excel()
 
-    def should_skip_case(self, case_number, temperature, try_number):
-        if ((self.df_execution_times['number'] == case_number) & 
-            (self.df_execution_times['temperature'] == temperature) & 
-            (self.df_execution_times['try'] == try_number)).any():
-            print(f"Case {case_number} (Temperature: {temperature}, Try: {try_number}): skip")
+    def get_image_paths(self, file_names):
+        image_paths = []
+        for file_name in file_names:
+            file_path = self.image_manifest.resolve(file_name)
+            if file_path:
+                image_paths.append(file_path)
+            else:
+                self.log_message(
+                    f"Warning: Image file not found for {file_name} in {self.case_folder}", 'warning'
+                )
+        return image_paths
+
+    def job_key(self, prompt, image_paths, temperature, try_number):
+        return jobs.job_key(
+            self.model, self.task, prompt.sha1,
+            jobs.image_set_digest(self.image_manifest, image_paths),
+            {
+                'temperature': temperature,
+                'try': try_number,
+                'crop_borders': self.crop_borders,
+                'montage_images': self.montage_images,
+                'dedupe_near_images': self.dedupe_near_images,
+            },
+        )
+
+    def should_skip_case(self, job, case_number, temperature, try_number):
+        if self.execution_ledger.has_job(job, case_number, temperature, try_number):
+            self.log_message(
+                f"Case {case_number} (Temperature: {temperature}, Try: {try_number}): skip",
+                job=job, case_number=case_number, temperature=temperature, try_number=try_number
+            )
             return True
         return False
 
@@ -222,41 +288,49 @@ class ClaudeVisionAnalyzer:
         }}
         """
 
-    def update_execution_times(self, case_number, temperature, try_number, execution_time):
-        new_row = pd.DataFrame({
-            'number': [case_number],
-            'temperature': [temperature],
-            'try': [try_number],
-            'time': [execution_time]
-        })
-        
-        existing_entry = (
-            (self.df_execution_times['number'] == case_number) & 
-            (self.df_execution_times['temperature'] == temperature) & 
-            (self.df_execution_times['try'] == try_number)
+    def update_execution_times(self, case_number, temperature, try_number, execution_time, payload_bytes=None, job=None):
+        job_fields = self.job_timer.ledger_fields()
+        job_fields.update(self.job_usage.ledger_fields(self.model))
+        self.execution_ledger.record(
+            case_number, temperature, try_number, execution_time, payload_bytes, job=job, **job_fields
+        )
+        self.run_log.log(
+            'info', 'job finished', job=job, case_number=case_number, temperature=temperature,
+            try_number=try_number, execution_time=execution_time, payload_bytes=payload_bytes, **job_fields
+        )
+
+    def check_result_json(self, case_number, result_text):
+        """Count and log an answer without a parsable JSON object; the raw text is still saved."""
+        try:
+            json.loads(result_text[result_text.index('{'):result_text.rindex('}') + 1])
+        except ValueError as e:
+            self.job_timer.count('parse_failures')
+            self.log_message(
+                f"Failed to parse JSON result for case {case_number}: {e}", 'warning',
+                reason='parse_failure', error_class=type(e).__name__, case_number=case_number
+            )
+
+    def save_result(self, result, job, result_file_path, case_number, temperature, try_number,
+                    execution_time=None):
+        self.result_store.put(
+            job, result_file_path, case_number, temperature, try_number,
+            result, latency=execution_time,
+            usage=self.job_usage.as_dict(self.model)
+        )
+        self.log_message(
+            f"Case {case_number} (Temperature: {temperature}, Try: {try_number}): Result has been saved.",
+            job=job, case_number=case_number, temperature=temperature, try_number=try_number
+        )
+
+    def log_no_result(self, job, result_file_path, case_number, temperature, try_number):
+        self.result_store.put(
+            job, result_file_path, case_number, temperature, try_number,
+            None, status='no_result', usage=self.job_usage.as_dict(self.model)
         )
-        
-        if existing_entry.any():
-            self.df_execution_times.loc[existing_entry, 'time'] = execution_time
-        else:
-            self.df_execution_times = pd.concat([self.df_execution_times, new_row], ignore_index=True)
-        
-        self.df_execution_times = self.df_execution_times.astype({
-            'number': 'int',
-            'temperature': 'float',
-            'try': 'int',
-            'time': 'float'
-        })
-
-    def save_result(self, result, result_file_path, case_number, temperature, try_number):
-        with open(result_file_path, "w") as result_file:
-            result_file.write(result)
-        print(f"Case {case_number} (Temperature: {temperature}, Try: {try_number}): Result has been saved.")
-
-    def log_no_result(self, case_number, temperature, try_number):
         message = f"Case {case_number} (Temperature: {temperature}, Try: {try_number}): No result found."
-        print(message)
-        self.log_message(message)
+        self.log_message(
+            message, job=job, case_number=case_number, temperature=temperature, try_number=try_number
+        )
 
 def main():
     api_key = os.getenv("ANTHROPIC_API_KEY")
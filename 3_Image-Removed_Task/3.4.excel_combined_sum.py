@@ -1,17 +1,21 @@
 import os
+import sys
 import pandas as pd
 from openpyxl import Workbook, load_workbook
 import json
 import re
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lancet_vlm import case_sources
+
 
 class ExcelProcessor:
-    def __init__(self, base_models, variations, max_num=227):
+    def __init__(self, base_models, variations, case_source=None, case_range=None):
         self.base_models = base_models
         self.variations = variations
         self.temperatures = [0, 0.5, 1]
         self.tries = range(1, 6)
-        self.max_num = max_num
+        self.cases = case_sources.open_source(case_source, case_range)
         self.folder_paths = self.generate_folder_paths()
 
     def generate_folder_paths(self):
@@ -45,7 +49,7 @@ class ExcelProcessor:
             ws = wb.active
             ws.append(['case_number', 'answer', 'reason'])
 
-            for i in range(1, self.max_num + 1):
+            for i in self.cases.case_numbers():
                 file_path = os.path.join(folder_path, f'{i}.txt')
                 try:
                     with open(file_path, 'r', encoding='utf-8') as file:
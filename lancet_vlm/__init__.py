@@ -0,0 +1 @@
+"""Shared helpers for the Lancet picture-quiz analyzer scripts."""
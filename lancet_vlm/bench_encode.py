@@ -0,0 +1,101 @@
+"""Benchmark sequential vs. thread-pool image preparation on the largest cases.
+
+Every repeat decodes and re-encodes each image. With ``--pipeline`` the
+analyzers' encoder is timed instead, passthrough included, against an
+encode cache that is emptied before each repeat, so ``cache/encoded`` never
+answers for it.
+
+Usage (from the repository root):
+
+    python -m lancet_vlm.bench_encode --cases 10 --provider openai
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from PIL import Image
+
+from lancet_vlm import case_table, imaging, manifest
+from lancet_vlm.paths import WORKBOOK_PATH
+
+
+def largest_cases(image_manifest, workbook_path, count):
+    numbered = [case for case in case_table.load_cases(workbook_path) if case.number is not None]
+    largest = sorted(numbered, key=lambda case: case.image_count or 0, reverse=True)[:count]
+    cases = []
+    for case in largest:
+        image_paths = [
+            path for path in map(image_manifest.resolve, case.file_names)
+            if path and image_manifest.is_large_enough(image_manifest.get(path))
+        ]
+        if image_paths:
+            cases.append((case.number, image_paths))
+    return cases
+
+
+def reencode_path(image_path, provider):
+    with Image.open(image_path) as img:
+        return imaging.process_and_encode_image(
+            img, max_size=imaging.PROVIDER_PROFILES[provider]['max_bytes']
+        )
+
+
+def clear_encoded_cache():
+    shutil.rmtree(imaging.ENCODED_CACHE_FOLDER, ignore_errors=True)
+
+
+def best_of(repeats, function):
+    timings = []
+    for _ in range(repeats):
+        clear_encoded_cache()
+        start_time = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start_time)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workbook', default=WORKBOOK_PATH)
+    parser.add_argument('--cases', type=int, default=10)
+    parser.add_argument('--provider', default='openai', choices=sorted(imaging.PROVIDER_PROFILES))
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--pipeline', action='store_true',
+                        help='time the analyzers\' encoder (passthrough, then re-encode) on a cold cache')
+    args = parser.parse_args()
+
+    if args.pipeline:
+        def encode_one(image_path):
+            return imaging.encode_image_path(image_path, args.provider)
+    else:
+        def encode_one(image_path):
+            return reencode_path(image_path, args.provider)
+
+    image_manifest = manifest.load_manifest()
+    cases = largest_cases(image_manifest, args.workbook, args.cases)
+    print(f"Image workers: {imaging.IMAGE_WORKERS}")
+    print(f"{'case':>6} {'images':>6} {'sequential':>11} {'parallel':>9} {'speedup':>8}")
+
+    total_sequential = total_parallel = 0.0
+    with tempfile.TemporaryDirectory() as folder:
+        # Keep the benchmark's encodes out of the repo's cache/encoded.
+        imaging.ENCODED_CACHE_FOLDER = os.path.join(folder, 'encoded')
+        for case_number, image_paths in cases:
+            sequential = best_of(args.repeats, lambda: [encode_one(path) for path in image_paths])
+            parallel = best_of(args.repeats, lambda: imaging.map_images(encode_one, image_paths))
+            total_sequential += sequential
+            total_parallel += parallel
+            print(f"{case_number:>6} {len(image_paths):>6} {sequential:>10.3f}s "
+                  f"{parallel:>8.3f}s {sequential / parallel:>7.2f}x")
+
+    if cases:
+        print(f"{'total':>6} {'':>6} {total_sequential:>10.3f}s {total_parallel:>8.3f}s "
+              f"{total_sequential / total_parallel:>7.2f}x")
+        if args.pipeline:
+            print(f"Encoder: {imaging.encode_stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""Lazy case sources for quiz corpora in Excel, CSV, JSONL or Parquet form.
+
+A source is re-iterable: each pass reopens the file and yields ``Case``
+records one at a time, optionally restricted to a case-number range so a
+large corpus can be split into shards across runs. Only small workbooks
+such as Lancet_QnA.xlsx go through the cached ``case_table``.
+"""
+import csv
+import json
+import os
+
+from openpyxl import load_workbook
+
+from lancet_vlm import case_table
+from lancet_vlm.paths import WORKBOOK_PATH
+
+# Workbooks at or below this size are served from the case_table cache.
+CACHED_WORKBOOK_BYTES = 5 * 1024 * 1024
+
+PARQUET_BATCH_ROWS = 4096
+
+# Environment variable used when no case range is passed, e.g. "1-500".
+CASE_RANGE_ENV = 'LANCET_CASE_RANGE'
+
+INTEGER_FIELDS = ('number', 'image_count')
+
+
+class CaseRange:
+    """Inclusive case-number range; either bound may be None."""
+
+    def __init__(self, start=None, stop=None):
+        self.start = start
+        self.stop = stop
+
+    def __contains__(self, case_number):
+        if case_number is None:
+            return False
+        if self.start is not None and case_number < self.start:
+            return False
+        if self.stop is not None and case_number > self.stop:
+            return False
+        return True
+
+    def __repr__(self):
+        return f"CaseRange({self.start!r}, {self.stop!r})"
+
+
+def parse_case_range(value):
+    """Accept None, a CaseRange, a (start, stop) pair or text such as "1-500", "228-" or "42"."""
+    if value is None or isinstance(value, CaseRange):
+        return value
+    if isinstance(value, (tuple, list)):
+        return CaseRange(*value)
+    value = str(value).strip()
+    if not value:
+        return None
+    if '-' not in value:
+        return CaseRange(int(value), int(value))
+    start, stop = value.split('-', 1)
+    return CaseRange(int(start) if start.strip() else None, int(stop) if stop.strip() else None)
+
+
+def make_case(record):
+    """Build a Case from a record keyed by workbook headings (``no.``, ``Q.``...) or field names."""
+    values = {}
+    for column, field in case_table.CASE_COLUMNS.items():
+        value = record.get(column, record.get(field))
+        if value == '':
+            value = None
+        if field in INTEGER_FIELDS:
+            value = case_table.to_integer(value)
+        values[field] = case_table.clean_value(value) if value is not None else None
+    return case_table.Case(**values)
+
+
+def iter_excel(path):
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        for row in rows:
+            yield dict(zip(header, row))
+    finally:
+        workbook.close()
+
+
+def iter_cached_workbook(path):
+    # Yield plain records so cached rows get the same coercion and filtering as every other reader.
+    for case in case_table.load_cases(path):
+        yield {field: getattr(case, field) for field in case_table.CASE_COLUMNS.values()}
+
+
+def iter_csv(path):
+    with open(path, 'r', encoding='utf-8', newline='') as csv_file:
+        for record in csv.DictReader(csv_file):
+            yield record
+
+
+def iter_jsonl(path):
+    with open(path, 'r', encoding='utf-8') as jsonl_file:
+        for line in jsonl_file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def iter_parquet(path):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Reading Parquet case sources requires pyarrow (pip install pyarrow)")
+    parquet_file = pq.ParquetFile(path)
+    columns = [
+        name for name in parquet_file.schema_arrow.names
+        if name in case_table.CASE_COLUMNS or name in case_table.CASE_COLUMNS.values()
+    ]
+    for batch in parquet_file.iter_batches(batch_size=PARQUET_BATCH_ROWS, columns=columns):
+        for record in batch.to_pylist():
+            yield record
+
+
+READERS = {
+    '.xlsx': iter_excel,
+    '.xlsm': iter_excel,
+    '.csv': iter_csv,
+    '.jsonl': iter_jsonl,
+    '.parquet': iter_parquet,
+}
+
+
+class CaseSource:
+    def __init__(self, path, case_range=None):
+        self.path = path
+        self.case_range = parse_case_range(case_range)
+        extension = os.path.splitext(path)[1].lower()
+        if extension not in READERS:
+            raise ValueError(f"Unsupported case source {path}; expected one of {sorted(READERS)}")
+        self.reader = READERS[extension]
+        if self.reader is iter_excel and os.path.getsize(path) <= CACHED_WORKBOOK_BYTES:
+            self.reader = iter_cached_workbook
+
+    def __iter__(self):
+        for record in self.reader(self.path):
+            case = make_case(record)
+            if case.number is None:
+                continue
+            if self.case_range is None or case.number in self.case_range:
+                yield case
+
+    def case_numbers(self):
+        for case in self:
+            yield case.number
+
+    def __repr__(self):
+        return f"CaseSource({self.path!r}, case_range={self.case_range!r})"
+
+
+def open_source(path=None, case_range=None):
+    """Open a case source, defaulting to Lancet_QnA.xlsx and the LANCET_CASE_RANGE shard."""
+    if case_range is None:
+        case_range = os.getenv(CASE_RANGE_ENV)
+    return CaseSource(path or WORKBOOK_PATH, case_range)
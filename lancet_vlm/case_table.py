@@ -0,0 +1,138 @@
+"""Quiz cases from Lancet_QnA.xlsx, parsed once and cached as a columnar JSON file.
+
+The cache is reused while the workbook's mtime is unchanged; if only the
+mtime moved, the content hash decides whether the workbook is re-parsed.
+Integer columns are converted when the table is built, so placeholder cells
+such as the template row's ``…`` are stored as None rather than as text.
+"""
+import hashlib
+import json
+import math
+import os
+
+import pandas as pd
+
+from lancet_vlm.paths import CACHE_FOLDER, WORKBOOK_PATH
+
+# Workbook column -> Case attribute.
+CASE_COLUMNS = {
+    'no.': 'number',
+    'Q.': 'question',
+    'jpg': 'jpg',
+    'new_q': 'new_q',
+    'new_c': 'new_c',
+    'Image Count': 'image_count',
+}
+INTEGER_COLUMNS = ('no.', 'Image Count')
+
+# Bumped when the cached columns change form, so older cache files are re-parsed.
+CACHE_VERSION = 2
+
+_loaded_cases = {}
+
+
+class Case:
+    __slots__ = tuple(CASE_COLUMNS.values())
+
+    def __init__(self, number, question, jpg, new_q, new_c, image_count):
+        self.number = number
+        self.question = question
+        self.jpg = jpg
+        self.new_q = new_q
+        self.new_c = new_c
+        self.image_count = image_count
+
+    @property
+    def file_names(self):
+        """Image file names listed in the `jpg` column, as in the analyzer scripts."""
+        return [file_name.strip() for file_name in str(self.jpg).split(',')]
+
+    def __repr__(self):
+        return f"Case(number={self.number!r}, image_count={self.image_count!r})"
+
+
+def clean_value(value):
+    """Turn NaN into None and whole floats (from NaN-padded int columns) into ints."""
+    if isinstance(value, float):
+        if math.isnan(value):
+            return None
+        if value.is_integer():
+            return int(value)
+    if hasattr(value, 'item'):
+        return clean_value(value.item())
+    return value
+
+
+def to_integer(value):
+    """Return ``value`` as an int, or None for blanks and non-numeric cells."""
+    if value is None or value == '':
+        return None
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def workbook_hash(workbook_path):
+    with open(workbook_path, 'rb') as workbook_file:
+        return hashlib.sha1(workbook_file.read()).hexdigest()
+
+
+def cache_path(workbook_path):
+    name = os.path.splitext(os.path.basename(workbook_path))[0]
+    return os.path.join(CACHE_FOLDER, f"{name}_cases.json")
+
+
+def parse_workbook(workbook_path):
+    """Read the case columns from the workbook into {column: [values]}."""
+    df = pd.read_excel(workbook_path)
+    columns = {
+        column: [clean_value(value) for value in df[column]] if column in df else [None] * len(df)
+        for column in CASE_COLUMNS
+    }
+    for column in INTEGER_COLUMNS:
+        columns[column] = [to_integer(value) for value in columns[column]]
+    return columns
+
+
+def write_cache(path, columns, mtime_ns, digest):
+    os.makedirs(CACHE_FOLDER, exist_ok=True)
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w') as cache_file:
+        json.dump(
+            {'version': CACHE_VERSION, 'mtime_ns': mtime_ns, 'sha1': digest, 'columns': columns}, cache_file
+        )
+    os.replace(temporary_path, path)
+
+
+def load_columns(workbook_path):
+    path = cache_path(workbook_path)
+    mtime_ns = os.stat(workbook_path).st_mtime_ns
+    cached = None
+    if os.path.exists(path):
+        with open(path, 'r') as cache_file:
+            cached = json.load(cache_file)
+        if cached.get('version') != CACHE_VERSION:
+            cached = None
+        elif cached['mtime_ns'] == mtime_ns:
+            return cached['columns']
+
+    digest = workbook_hash(workbook_path)
+    if cached is not None and cached['sha1'] == digest:
+        columns = cached['columns']
+    else:
+        print(f"Parsing {workbook_path}")
+        columns = parse_workbook(workbook_path)
+    write_cache(path, columns, mtime_ns, digest)
+    return columns
+
+
+def load_cases(workbook_path=WORKBOOK_PATH):
+    """Return the quiz cases as a list of ``Case`` records, parsing the workbook at most once."""
+    key = os.path.abspath(workbook_path)
+    if key not in _loaded_cases:
+        columns = load_columns(workbook_path)
+        _loaded_cases[key] = [
+            Case(*values) for values in zip(*(columns[column] for column in CASE_COLUMNS))
+        ]
+    return _loaded_cases[key]
@@ -0,0 +1,224 @@
+"""Record API responses to a cassette and replay them offline.
+
+With ``LANCET_CASSETTE=record`` every API attempt an analyzer makes is
+appended to ``cassettes/<model>_<task>.jsonl.gz``: a fingerprint of the
+request (model, parameters, prompt and image digests), its latency and the
+response the SDK returned or the error it raised. With
+``LANCET_CASSETTE=replay`` the same requests are answered from the cassette
+inside ``analyze_images_with_*``, so refusals, retries, parsing and
+persistence run as they did when recorded, without network access or API
+quota. A request sent several times (the tries of a job, retries after a
+refusal) gets its recorded responses in order.
+
+Replies are immediate unless ``LANCET_REPLAY_LATENCY`` is ``recorded`` (sleep
+each interaction's own latency) or ``sampled`` (draw from the cassette's
+latency distribution). ``LANCET_CASSETTE_DIR`` points a replay run in a
+scratch folder at the recorded cassettes.
+
+Usage (from the folder the analyzers were run in):
+
+    python -m lancet_vlm.cassette cassettes/*.jsonl.gz
+"""
+import argparse
+import collections
+import gzip
+import hashlib
+import json
+import os
+import random
+import time
+
+from lancet_vlm import stats
+
+CASSETTE_FOLDER = 'cassettes'
+
+MODE_ENV = 'LANCET_CASSETTE'
+FOLDER_ENV = 'LANCET_CASSETTE_DIR'
+LATENCY_ENV = 'LANCET_REPLAY_LATENCY'
+
+MODES = ('record', 'replay')
+LATENCY_MODES = ('recorded', 'sampled')
+
+# Strings longer than this (base64 images, long prompts) are fingerprinted by digest.
+DIGEST_MIN_LENGTH = 1024
+
+
+class CassetteMiss(Exception):
+    """A replayed request has no (further) recorded response."""
+
+
+class ReplayedError(Exception):
+    """An error from the cassette, raised again under its recorded class name."""
+
+
+_error_classes = {}
+
+
+def replayed_error(class_name, message):
+    if class_name not in _error_classes:
+        _error_classes[class_name] = type(class_name, (ReplayedError,), {})
+    return _error_classes[class_name](message)
+
+
+def digest(data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return 'sha1:' + hashlib.sha1(data).hexdigest()
+
+
+def canonical(value):
+    """JSON form of a request argument with image data replaced by its digest."""
+    if isinstance(value, dict):
+        return {str(key): canonical(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [canonical(item) for item in value]
+    if isinstance(value, (bytes, bytearray)):
+        return digest(bytes(value))
+    if isinstance(value, str):
+        return digest(value) if len(value) > DIGEST_MIN_LENGTH else value
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return repr(value)
+
+
+def fingerprint(provider, args, kwargs, context=None):
+    request = {
+        'provider': provider,
+        'context': canonical(context or {}),
+        'args': canonical(args),
+        'kwargs': canonical(kwargs),
+    }
+    return hashlib.sha1(json.dumps(request, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+def dump_response(provider, response):
+    if provider == 'gemini':
+        return response.to_dict()
+    return response.model_dump(mode='json')
+
+
+def load_response(provider, data):
+    """Rebuild the SDK's response object, so the analyzer reads it as if it came from the API."""
+    if provider == 'openai':
+        from openai.types.chat import ChatCompletion
+        return ChatCompletion.model_validate(data)
+    if provider == 'anthropic':
+        from anthropic.types import Message
+        return Message.model_validate(data)
+    import google.ai.generativelanguage as glm
+    from google.generativeai.types import GenerateContentResponse
+    return GenerateContentResponse.from_response(glm.GenerateContentResponse(data))
+
+
+def read_cassette(path):
+    """Recorded interactions in order; a batch cut short by a crash ends the cassette."""
+    interactions = []
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as cassette_file:
+            for line in cassette_file:
+                interactions.append(json.loads(line))
+    except (EOFError, ValueError) as e:
+        print(f"Warning: {path} is truncated after {len(interactions)} interactions - {e}")
+    return interactions
+
+
+class Cassette:
+    """Sends API calls through unchanged, or records or replays them (``mode``)."""
+
+    # A recording that cannot be written must not hold back result rows or ledger records.
+    independent = True
+
+    def __init__(self, path, mode=None, writer=None, latency=None):
+        self.path = path
+        self.mode = mode
+        self.writer = writer
+        self.latency = latency
+        self.interactions = {}
+        self.positions = {}
+        self.latency_stats = stats.LatencyStats()
+        if mode == 'replay':
+            for interaction in read_cassette(path):
+                self.interactions.setdefault(interaction['fingerprint'], []).append(interaction)
+                self.latency_stats.add(interaction['latency'])
+            print(f"Replaying {self.latency_stats.count} recorded responses from {path}")
+
+    def call(self, provider, send, *args, context=None, **kwargs):
+        """``send(*args, **kwargs)``; ``context`` adds request settings not passed to ``send``."""
+        if self.mode is None:
+            return send(*args, **kwargs)
+        key = fingerprint(provider, args, kwargs, context)
+        if self.mode == 'replay':
+            return self.replay(provider, key)
+        return self.record(provider, key, send, args, kwargs)
+
+    def record(self, provider, key, send, args, kwargs):
+        interaction = {'fingerprint': key}
+        clock_start = time.perf_counter()
+        try:
+            response = send(*args, **kwargs)
+        except Exception as e:
+            interaction['latency'] = round(time.perf_counter() - clock_start, 6)
+            interaction['error'] = {'class': type(e).__name__, 'message': str(e)}
+            self.writer.submit(self, interaction)
+            raise
+        interaction['latency'] = round(time.perf_counter() - clock_start, 6)
+        interaction['response'] = dump_response(provider, response)
+        self.writer.submit(self, interaction)
+        return response
+
+    def replay(self, provider, key):
+        recorded = self.interactions.get(key, [])
+        position = self.positions.get(key, 0)
+        if position >= len(recorded):
+            raise CassetteMiss(f"No recorded response for request {key[:12]} (call {position + 1})")
+        self.positions[key] = position + 1
+        interaction = recorded[position]
+        if self.latency == 'recorded':
+            time.sleep(interaction['latency'])
+        elif self.latency == 'sampled':
+            time.sleep(self.latency_stats.quantile(random.random()))
+        if 'error' in interaction:
+            raise replayed_error(interaction['error']['class'], interaction['error']['message'])
+        return load_response(provider, interaction['response'])
+
+    def write_batch(self, interactions):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # Each batch is appended as its own gzip member; gzip.open reads them back as one stream.
+        with gzip.open(self.path, 'at', encoding='utf-8') as cassette_file:
+            cassette_file.write(''.join(json.dumps(item, separators=(',', ':')) + '\n' for item in interactions))
+
+
+def open_cassette(model, task, writer):
+    mode = os.getenv(MODE_ENV) or None
+    if mode is not None and mode not in MODES:
+        raise ValueError(f"{MODE_ENV} must be one of {', '.join(MODES)}, not {mode!r}")
+    latency = os.getenv(LATENCY_ENV) or None
+    if latency is not None and latency not in LATENCY_MODES:
+        raise ValueError(f"{LATENCY_ENV} must be one of {', '.join(LATENCY_MODES)}, not {latency!r}")
+    folder = os.getenv(FOLDER_ENV) or CASSETTE_FOLDER
+    return Cassette(os.path.join(folder, f"{model}_{task}.jsonl.gz"), mode, writer, latency)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('cassette_files', nargs='+', help='cassettes/*.jsonl.gz')
+    args = parser.parse_args()
+    for path in args.cassette_files:
+        interactions = read_cassette(path)
+        latency_stats = stats.LatencyStats()
+        errors = collections.Counter()
+        for interaction in interactions:
+            latency_stats.add(interaction['latency'])
+            if 'error' in interaction:
+                errors[interaction['error']['class']] += 1
+        requests = len({interaction['fingerprint'] for interaction in interactions})
+        print(f"{path}: {len(interactions)} responses for {requests} distinct requests, "
+              f"{os.path.getsize(path) / 1024:.1f} KiB")
+        if errors:
+            print("Errors: " + ', '.join(f"{name} {count}" for name, count in errors.most_common()))
+        if latency_stats.count:
+            latency_stats.print_report()
+
+
+if __name__ == "__main__":
+    main()
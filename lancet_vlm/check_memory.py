@@ -0,0 +1,140 @@
+"""Memory regression check for the Gemini inline image parts.
+
+Simulates a full sweep of requests (3,405 = 227 cases x 15 runs by default)
+through image preparation and Gemini part construction without calling the
+API. It fails when the process's resident memory or open file descriptors
+keep growing after the warm-up, which is how the old per-retry PIL images
+leaked. Resident memory includes Pillow's C-side pixel buffers, which
+tracemalloc does not see.
+
+Encoded images are cached in a temporary folder that is emptied before
+every request, so each request decodes and re-encodes its images instead of
+reading an earlier result from ``cache/encoded``.
+
+    python -m lancet_vlm.check_memory --requests 3405
+"""
+import argparse
+import itertools
+import os
+import resource
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+from lancet_vlm import imaging, manifest
+
+WARMUP_REQUESTS = 50
+IMAGES_PER_REQUEST = 4
+
+
+def resident_memory():
+    """Current resident set size in bytes, or the peak where /proc is unavailable."""
+    if os.path.exists('/proc/self/statm'):
+        with open('/proc/self/statm') as statm_file:
+            resident_pages = int(statm_file.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE')
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def open_file_descriptors():
+    if os.path.isdir('/proc/self/fd'):
+        return len(os.listdir('/proc/self/fd'))
+    return None
+
+
+def synthetic_images(folder):
+    """Write images that exercise passthrough, PNG re-encode and oversized JPEG paths."""
+    gradient = np.tile(np.linspace(0, 255, 3500, dtype=np.uint8), (3500, 1))
+    noise = np.random.default_rng(0).integers(0, 256, (1200, 1200, 3), dtype=np.uint8)
+    specs = [
+        ('passthrough.jpg', Image.fromarray(noise), 'JPEG'),
+        ('reencode.png', Image.fromarray(noise[:800, :800]), 'PNG'),
+        ('oversized.jpg', Image.fromarray(gradient), 'JPEG'),
+        ('grayscale_rgb.jpg', Image.fromarray(gradient[:1500, :1500]).convert('RGB'), 'JPEG'),
+    ]
+    paths = []
+    for name, image, image_format in specs:
+        path = os.path.join(folder, name)
+        image.save(path, format=image_format)
+        paths.append(path)
+    return paths
+
+
+def quiz_images():
+    image_manifest = manifest.load_manifest()
+    return [image_manifest.path(entry) for entry in image_manifest.entries]
+
+
+def run_request(image_paths):
+    """Prepare one request's images the way the Gemini analyzers do."""
+    shutil.rmtree(imaging.ENCODED_CACHE_FOLDER, ignore_errors=True)
+    encoded_images = [
+        encoded_image
+        for encoded_image in imaging.encode_image_paths(image_paths, 'gemini', return_exceptions=True)
+        if not isinstance(encoded_image, Exception)
+    ]
+    images = [imaging.inline_image_part(encoded_image) for encoded_image in encoded_images]
+    message_contents = ["prompt"] + images
+    return sum(len(part['data']) for part in message_contents[1:])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=3405)
+    parser.add_argument('--max-growth-mb', type=float, default=32.0)
+    parser.add_argument('--synthetic', action='store_true',
+                        help='use generated images even if Lancet_IMAGE240508 exists')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        # Keep re-encoded results (and the synthetic images' digests) out of the repo's cache.
+        imaging.ENCODED_CACHE_FOLDER = os.path.join(folder, 'encoded')
+        image_paths = [] if args.synthetic else quiz_images()
+        if not image_paths:
+            print("Using synthetic images")
+            image_paths = synthetic_images(folder)
+
+        groups = itertools.cycle(
+            image_paths[start:start + IMAGES_PER_REQUEST]
+            for start in range(0, len(image_paths), IMAGES_PER_REQUEST)
+        )
+
+        baseline_memory = baseline_fds = None
+        peak_memory = 0
+        for request in range(1, args.requests + 1):
+            run_request(next(groups))
+            current = resident_memory()
+            peak_memory = max(peak_memory, current)
+            if request == WARMUP_REQUESTS:
+                baseline_memory = current
+                baseline_fds = open_file_descriptors()
+            if request % 500 == 0:
+                print(f"{request} requests: RSS {current / 2**20:.1f} MB, "
+                      f"peak {peak_memory / 2**20:.1f} MB, fds {open_file_descriptors()}")
+
+        final_memory = resident_memory()
+        final_fds = open_file_descriptors()
+        print(f"Encoder: {imaging.encode_stats}")
+
+    if baseline_memory is None:
+        print(f"Run at least {WARMUP_REQUESTS + 1} requests to measure growth")
+        return 0
+
+    growth_mb = (final_memory - baseline_memory) / 2**20
+    print(f"RSS growth after warm-up: {growth_mb:.2f} MB (peak {peak_memory / 2**20:.1f} MB)")
+    print(f"Open file descriptors: {baseline_fds} -> {final_fds}")
+
+    failed = growth_mb > args.max_growth_mb
+    if baseline_fds is not None and final_fds > baseline_fds:
+        failed = True
+    print("FAIL" if failed else "OK")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,210 @@
+"""Exact and perceptual duplicate detection over the image manifest.
+
+Exact duplicates (same SHA-1) are always served as one asset. Near
+duplicates (re-saved or resized copies whose 64-bit difference hash is
+within ``NEAR_DUPLICATE_DISTANCE`` bits) are merged only on request, because
+substituting them changes the pixels a model sees.
+
+    python -m lancet_vlm.dedupe            # build the index and print the savings report
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+from PIL import Image
+
+from lancet_vlm import case_table, imaging, manifest
+from lancet_vlm.paths import CACHE_FOLDER, WORKBOOK_PATH
+
+HASH_SIZE = 8
+NEAR_DUPLICATE_DISTANCE = 4
+RUNS_PER_SWEEP = 15  # 3 temperatures x 5 tries
+PHASH_FILE_NAME = "phashes.json"
+
+
+def difference_hash(image_path, hash_size=HASH_SIZE):
+    """Return the 64-bit dHash of an image as an int."""
+    with Image.open(image_path) as img:
+        img.draft('L', (hash_size * 4, hash_size * 4))
+        small = img.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hamming_distance(first, second):
+    return bin(first ^ second).count('1')
+
+
+class DisjointSet:
+    def __init__(self):
+        self.parents = {}
+
+    def find(self, item):
+        self.parents.setdefault(item, item)
+        while self.parents[item] != item:
+            self.parents[item] = self.parents[self.parents[item]]
+            item = self.parents[item]
+        return item
+
+    def union(self, first, second):
+        self.parents[self.find(first)] = self.find(second)
+
+
+def phash_path(folder):
+    return os.path.join(CACHE_FOLDER, f"{os.path.basename(folder)}_{PHASH_FILE_NAME}")
+
+
+def load_phashes(image_manifest):
+    """Return {sha1: dHash} for the manifest, hashing only digests not seen before."""
+    cache_path = phash_path(image_manifest.folder)
+    phashes = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r') as phash_file:
+            phashes = {digest: int(value, 16) for digest, value in json.load(phash_file).items()}
+
+    missing = {}
+    for entry in image_manifest.entries:
+        if entry['sha1'] not in phashes:
+            missing[entry['sha1']] = image_manifest.path(entry)
+    if missing:
+        hashes = imaging.map_images(difference_hash, list(missing.values()), return_exceptions=True)
+        for digest, value in zip(missing, hashes):
+            if isinstance(value, Exception):
+                print(f"Error hashing image {missing[digest]}: {value}")
+            else:
+                phashes[digest] = value
+
+        os.makedirs(CACHE_FOLDER, exist_ok=True)
+        with open(cache_path, 'w') as phash_file:
+            json.dump({digest: f"{value:016x}" for digest, value in phashes.items()}, phash_file)
+    return phashes
+
+
+def near_duplicate_pairs(phashes, max_distance=NEAR_DUPLICATE_DISTANCE):
+    """Yield digest pairs within ``max_distance`` bits.
+
+    Splitting the hash into ``max_distance + 1`` bands means any such pair
+    agrees exactly on at least one band, so only band collisions are compared.
+    """
+    bands = max_distance + 1
+    bits = HASH_SIZE * HASH_SIZE
+    edges = [round(band * bits / bands) for band in range(bands + 1)]
+    buckets = {}
+    for digest, value in phashes.items():
+        for band in range(bands):
+            width = edges[band + 1] - edges[band]
+            key = (band, (value >> edges[band]) & ((1 << width) - 1))
+            buckets.setdefault(key, []).append(digest)
+
+    seen = set()
+    for digests in buckets.values():
+        for index, first in enumerate(digests):
+            for second in digests[index + 1:]:
+                pair = (first, second) if first < second else (second, first)
+                if pair in seen:
+                    continue
+                seen.add(pair)
+                if hamming_distance(phashes[first], phashes[second]) <= max_distance:
+                    yield pair
+
+
+class DedupeIndex:
+    """Maps every image digest to the canonical asset of its duplicate group."""
+
+    def __init__(self, image_manifest, near=False, max_distance=NEAR_DUPLICATE_DISTANCE):
+        self.image_manifest = image_manifest
+        self.near = near
+        groups = DisjointSet()
+        by_digest = {}
+        for entry in image_manifest.entries:
+            by_digest.setdefault(entry['sha1'], []).append(entry)
+            groups.find(entry['sha1'])
+
+        if near:
+            for first, second in near_duplicate_pairs(load_phashes(image_manifest), max_distance):
+                groups.union(first, second)
+
+        members = {}
+        for digest in by_digest:
+            members.setdefault(groups.find(digest), []).append(digest)
+
+        # The canonical asset of a group is its highest-resolution image.
+        self.canonical = {}
+        for group in members.values():
+            best = max(
+                (entry for digest in group for entry in by_digest[digest]),
+                key=lambda entry: (entry['width'] * entry['height'], entry['name'])
+            )
+            for digest in group:
+                self.canonical[digest] = (best['sha1'], image_manifest.path(best))
+
+    def aliases(self):
+        """Return the {digest: (canonical digest, path)} entries that point elsewhere."""
+        return {
+            digest: canonical for digest, canonical in self.canonical.items()
+            if canonical[0] != digest
+        }
+
+    def asset(self, image_path):
+        entry = self.image_manifest.get(image_path)
+        if entry is None:
+            return None
+        return self.canonical[entry['sha1']][0]
+
+
+def load_index(image_manifest, near=False):
+    """Build the dedupe index and register its aliases with the encoder."""
+    index = DedupeIndex(image_manifest, near)
+    imaging.register_aliases(index.aliases())
+    return index
+
+
+def savings_report(index, workbook_path=WORKBOOK_PATH, runs=RUNS_PER_SWEEP):
+    """Print how many image uploads, bytes and encodes deduplication saves per sweep."""
+    image_manifest = index.image_manifest
+    references = []
+    for case in case_table.load_cases(workbook_path):
+        for file_name in case.file_names:
+            image_path = image_manifest.resolve(file_name)
+            if image_path:
+                references.append(image_manifest.get(image_path))
+
+    unique_files = {entry['name']: entry for entry in references}
+    unique_digests = {entry['sha1'] for entry in references}
+    unique_assets = {}
+    for entry in references:
+        asset_digest, asset_path = index.canonical[entry['sha1']]
+        unique_assets[asset_digest] = image_manifest.get(asset_path)
+
+    reference_bytes = sum(entry['bytes'] for entry in references)
+    asset_bytes = sum(entry['bytes'] for entry in unique_assets.values())
+    mode = "exact + near" if index.near else "exact"
+    print(f"Image references in {workbook_path}: {len(references)}")
+    print(f"Distinct files: {len(unique_files)}, distinct contents: {len(unique_digests)}, "
+          f"distinct assets ({mode}): {len(unique_assets)}")
+    print(f"Source bytes per run: {reference_bytes} referenced, {asset_bytes} unique assets "
+          f"({reference_bytes - asset_bytes} saved)")
+    print(f"Encodes per sweep ({runs} runs): {len(references) * runs} without dedupe, "
+          f"{len(unique_assets)} with the content-addressed cache")
+    for group_digest in sorted(unique_assets):
+        names = sorted(
+            entry['name'] for entry in unique_files.values()
+            if index.canonical[entry['sha1']][0] == group_digest
+        )
+        if len(names) > 1:
+            print(f"  duplicates: {', '.join(names)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workbook', default=WORKBOOK_PATH)
+    parser.add_argument('--near', action='store_true', help='also merge near-duplicate images')
+    args = parser.parse_args()
+    index = DedupeIndex(manifest.load_manifest(), near=args.near)
+    savings_report(index, args.workbook)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,479 @@
+import base64
+import hashlib
+import io
+import math
+import os
+import string
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from lancet_vlm.paths import CACHE_FOLDER
+
+MAX_SIZE = 20 * 1024 * 1024  # 20MB
+
+GRAYSCALE_MODES = ('1', 'L', 'LA', 'I', 'I;16', 'I;16B', 'I;16L', 'F')
+# 16/32-bit integer and float modes; convert('L') clips these, so they are rescaled instead.
+HIGH_DEPTH_MODES = ('I', 'I;16', 'I;16B', 'I;16L', 'F')
+GRAYSCALE_SAMPLE_SIZE = 128
+GRAYSCALE_TOLERANCE = 8
+
+BORDER_TOLERANCE = 16
+BORDER_NOISE_FRACTION = 0.005
+BORDER_PADDING = 2
+MIN_CROP_FRACTION = 0.02
+
+# What each provider accepts without further work on our side: the longest
+# edge it keeps before downscaling, and the largest encoded image it takes.
+# Anthropic's 5MB limit applies to the base64 payload, hence the 3/4 factor.
+PROVIDER_PROFILES = {
+    'openai': {'max_edge': 2048, 'max_bytes': MAX_SIZE},
+    'anthropic': {'max_edge': 1568, 'max_bytes': 5 * 1024 * 1024 * 3 // 4},
+    'gemini': {'max_edge': 3072, 'max_bytes': MAX_SIZE},
+}
+PASSTHROUGH_MODES = ('L', 'RGB')
+MIN_IMAGE_SIZE = 150
+MONTAGE_GUTTER = 8
+
+# Pillow releases the GIL while decoding, resizing and encoding JPEGs, so a
+# small thread pool shared by every analyzer prepares a case's images in parallel.
+IMAGE_WORKERS = min(8, os.cpu_count() or 1)
+_executor = None
+_executor_lock = threading.Lock()
+
+# Re-encoded JPEGs are kept on disk, keyed by provider and content hash, so
+# every script and run reuses them.
+ENCODED_CACHE_FOLDER = os.path.join(CACHE_FOLDER, "encoded")
+encode_stats = {'passthrough': 0, 'cache_hits': 0, 'encodes': 0, 'aliased': 0}
+
+# SHA-1 digests keyed by (absolute path, size, mtime_ns).
+_file_hashes = {}
+# Duplicate images map their digest to the (digest, path) of one canonical
+# asset; filled in by lancet_vlm.dedupe.
+_asset_aliases = {}
+# Crop boxes keyed by file content hash, so each image is analysed once per run
+# regardless of how many temperatures and tries reuse it.
+_crop_boxes = {}
+# Encoded montages keyed by (image hashes, provider, cropping), built once per run.
+_montages = {}
+# is_effectively_grayscale results for RGB JPEGs, keyed by file content hash.
+_grayscale_checks = {}
+
+
+def is_effectively_grayscale(image, sample_size=GRAYSCALE_SAMPLE_SIZE,
+                             tolerance=GRAYSCALE_TOLERANCE):
+    """Return True when every channel of a downsampled copy is (nearly) equal.
+
+    Radiographs, CT, MR and most ultrasound figures are stored as RGB JPEGs
+    even though they carry a single channel; JPEG chroma noise is absorbed by
+    ``tolerance``. Coloured annotations (arrows, Doppler) keep the image RGB.
+    """
+    if image.mode in GRAYSCALE_MODES:
+        return True
+
+    width, height = image.size
+    scale = min(1.0, sample_size / max(width, height))
+    sample = image.resize(
+        (max(1, int(width * scale)), max(1, int(height * scale))), Image.NEAREST
+    )
+    pixels = np.asarray(sample.convert('RGB'), dtype=np.int16)
+    red, green, blue = pixels[..., 0], pixels[..., 1], pixels[..., 2]
+    return bool(
+        np.abs(red - green).max() <= tolerance
+        and np.abs(red - blue).max() <= tolerance
+    )
+
+
+def file_hash(image_path, chunk_size=1024 * 1024):
+    """Return the SHA-1 hex digest of a file's bytes.
+
+    Digests are memoised on (path, size, mtime), so repeated tries only pay
+    for a ``stat`` call.
+    """
+    stat = os.stat(image_path)
+    key = (os.path.abspath(image_path), stat.st_size, stat.st_mtime_ns)
+    if key in _file_hashes:
+        return _file_hashes[key]
+
+    digest = hashlib.sha1()
+    with open(image_path, 'rb') as image_file:
+        for chunk in iter(lambda: image_file.read(chunk_size), b''):
+            digest.update(chunk)
+    _file_hashes[key] = digest.hexdigest()
+    return _file_hashes[key]
+
+
+def remember_file_hash(image_path, size, mtime_ns, digest):
+    """Seed the ``file_hash`` memo with a digest computed elsewhere (the manifest)."""
+    _file_hashes[(os.path.abspath(image_path), size, mtime_ns)] = digest
+
+
+def find_content_box(image, tolerance=BORDER_TOLERANCE,
+                     noise_fraction=BORDER_NOISE_FRACTION, padding=BORDER_PADDING):
+    """Return the (left, upper, right, lower) box inside uniform margins, or None.
+
+    The background level is taken from the four corners. A row or column is
+    content when more than ``noise_fraction`` of its pixels deviate from the
+    background by more than ``tolerance``, so burned-in labels and arrows in
+    the margin are kept. Returns None when there is nothing worth trimming.
+    """
+    gray = np.asarray(image.convert('L'), dtype=np.int16)
+    height, width = gray.shape
+    background = np.median([gray[0, 0], gray[0, -1], gray[-1, 0], gray[-1, -1]])
+    deviating = np.abs(gray - background) > tolerance
+
+    rows = np.flatnonzero(deviating.mean(axis=1) > noise_fraction)
+    columns = np.flatnonzero(deviating.mean(axis=0) > noise_fraction)
+    if rows.size == 0 or columns.size == 0:
+        return None
+
+    box = (
+        max(0, int(columns[0]) - padding),
+        max(0, int(rows[0]) - padding),
+        min(width, int(columns[-1]) + 1 + padding),
+        min(height, int(rows[-1]) + 1 + padding),
+    )
+    cropped_area = (box[2] - box[0]) * (box[3] - box[1])
+    if cropped_area > (1 - MIN_CROP_FRACTION) * width * height:
+        return None
+    return box
+
+
+def crop_box(image, image_key=None):
+    """Return the content box for ``image``, reusing the cached box for ``image_key``."""
+    if image_key is not None and image_key in _crop_boxes:
+        return _crop_boxes[image_key]
+
+    box = find_content_box(image)
+    if image_key is not None:
+        _crop_boxes[image_key] = box
+    return box
+
+
+def crop_borders(image, image_key=None):
+    """Trim uniform margins, reusing the cached box for ``image_key`` if known."""
+    box = crop_box(image, image_key)
+    if box is None:
+        return image
+    return image.crop(box)
+
+
+def rescale_to_8bit(image):
+    """Map a high-depth grayscale image's own min..max range onto 0..255 as an "L" image."""
+    pixels = np.asarray(image, dtype=np.float32)
+    low, high = float(pixels.min()), float(pixels.max())
+    if high > low:
+        pixels = (pixels - low) * (255.0 / (high - low))
+    else:
+        pixels = np.zeros_like(pixels)
+    return Image.fromarray(np.rint(pixels).astype(np.uint8), 'L')
+
+
+def prepare_for_jpeg(image):
+    """Convert an image to the JPEG mode it should be encoded in ("L" or "RGB")."""
+    if image.mode in HIGH_DEPTH_MODES:
+        return rescale_to_8bit(image)
+    if is_effectively_grayscale(image):
+        return image if image.mode == 'L' else image.convert('L')
+    if image.mode != 'RGB':
+        return image.convert('RGB')
+    return image
+
+
+def jpeg_bytes(image, resize_factor=0.9, max_size=MAX_SIZE):
+    """Re-encode ``image`` as JPEG bytes, shrinking it until it fits ``max_size``."""
+    original_width, original_height = image.size
+    image = prepare_for_jpeg(image)
+
+    for attempt in range(5):
+        buffered = io.BytesIO()
+        new_width = int(original_width * (resize_factor ** attempt))
+        new_height = int(original_height * (resize_factor ** attempt))
+        if attempt == 0:
+            resized_image = image
+        else:
+            resized_image = image.resize((new_width, new_height), Image.LANCZOS)
+        resized_image.save(buffered, format="JPEG")
+
+        if buffered.tell() < max_size:
+            return buffered.getvalue()
+        else:
+            print(f"Attempt {attempt + 1}: Image size is {buffered.tell()} bytes, too large. Resizing...")
+
+    raise ValueError("Unable to reduce image size within 5 attempts")
+
+
+def process_and_encode_image(image, resize_factor=0.9, max_size=MAX_SIZE):
+    """Encode ``image`` as a base64 JPEG, shrinking it until it fits ``max_size``."""
+    return base64.b64encode(jpeg_bytes(image, resize_factor, max_size)).decode("utf-8")
+
+
+def grayscale_check(image, image_key=None):
+    """``is_effectively_grayscale``, reusing the result for ``image_key`` if known."""
+    if image_key is not None and image_key in _grayscale_checks:
+        return _grayscale_checks[image_key]
+
+    grayscale = is_effectively_grayscale(image)
+    if image_key is not None:
+        _grayscale_checks[image_key] = grayscale
+    return grayscale
+
+
+def passthrough_bytes(image_path, image, provider, image_key=None):
+    """Return the file's own bytes if they already satisfy the provider profile.
+
+    The header PIL has already parsed and the file size rule out most
+    images without decoding pixels. An RGB JPEG is also sampled once per
+    content hash, so a grayscale scan stored as RGB is re-encoded as a
+    single channel rather than sent with three. Returns None when a
+    transform is required.
+    """
+    profile = PROVIDER_PROFILES[provider]
+    if image.format != 'JPEG' or image.mode not in PASSTHROUGH_MODES:
+        return None
+    if max(image.size) > profile['max_edge']:
+        return None
+    if os.path.getsize(image_path) >= profile['max_bytes']:
+        return None
+    if image.mode == 'RGB' and grayscale_check(image, image_key):
+        return None
+    with open(image_path, 'rb') as image_file:
+        return image_file.read()
+
+
+def fit_to_edge(image, max_edge):
+    """Shrink ``image`` so its longest edge is at most ``max_edge``.
+
+    For JPEGs that are not decoded yet, ``draft`` makes libjpeg decode at a
+    reduced scale, so oversized scans never exist in memory at full size.
+    """
+    if max(image.size) <= max_edge:
+        return image
+    image.draft(image.mode, (max_edge, max_edge))
+    scale = max_edge / max(image.size)
+    if scale >= 1:
+        return image
+    new_size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+    return image.resize(new_size, Image.LANCZOS)
+
+
+def register_aliases(aliases):
+    """Treat each digest in ``aliases`` as the canonical (digest, path) it maps to.
+
+    Replaces any earlier registration, so rebuilding the index without
+    near-duplicate merging also drops the near-duplicate aliases.
+    """
+    _asset_aliases.clear()
+    _asset_aliases.update(aliases)
+
+
+def encoded_cache_path(digest, provider, crop=False):
+    profile = PROVIDER_PROFILES[provider]
+    suffix = '_crop' if crop else ''
+    return os.path.join(
+        ENCODED_CACHE_FOLDER, provider,
+        f"{digest}_{profile['max_edge']}_{profile['max_bytes']}{suffix}.jpg"
+    )
+
+
+def read_encoded_cache(digest, provider, crop=False):
+    cache_path = encoded_cache_path(digest, provider, crop)
+    if not os.path.exists(cache_path):
+        return None
+    with open(cache_path, 'rb') as cache_file:
+        return cache_file.read()
+
+
+def write_encoded_cache(digest, provider, crop, data):
+    cache_path = encoded_cache_path(digest, provider, crop)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    temporary_path = f"{cache_path}.{threading.get_ident()}.tmp"
+    with open(temporary_path, 'wb') as cache_file:
+        cache_file.write(data)
+    os.replace(temporary_path, cache_path)
+
+
+def encode_image_bytes(image_path, image, provider, crop=False):
+    """Return JPEG bytes for a file-backed image, decoding only when required.
+
+    The result never exceeds the provider's byte limit or longest edge.
+    Duplicates registered through ``register_aliases`` are served from their
+    canonical asset, and re-encoded results are cached on disk by digest.
+    """
+    digest = file_hash(image_path)
+    canonical_digest, canonical_path = _asset_aliases.get(digest, (digest, image_path))
+    if canonical_digest != digest:
+        encode_stats['aliased'] += 1
+        with Image.open(canonical_path) as canonical_image:
+            return encode_image_bytes(canonical_path, canonical_image, provider, crop)
+
+    profile = PROVIDER_PROFILES[provider]
+    box = crop_box(image, digest) if crop else None
+    if box is None:
+        original_bytes = passthrough_bytes(image_path, image, provider, digest)
+        if original_bytes is not None:
+            encode_stats['passthrough'] += 1
+            return original_bytes
+
+    cached_bytes = read_encoded_cache(digest, provider, crop)
+    if cached_bytes is not None:
+        encode_stats['cache_hits'] += 1
+        return cached_bytes
+
+    if box is not None:
+        image = image.crop(box)
+    encoded_bytes = jpeg_bytes(fit_to_edge(image, profile['max_edge']), max_size=profile['max_bytes'])
+    encode_stats['encodes'] += 1
+    write_encoded_cache(digest, provider, crop, encoded_bytes)
+    return encoded_bytes
+
+
+def encode_image_file(image_path, image, provider, crop=False):
+    """Base64 counterpart of ``encode_image_bytes`` for the data-URL payloads."""
+    return base64.b64encode(
+        encode_image_bytes(image_path, image, provider, crop)
+    ).decode("utf-8")
+
+
+def inline_image_part(encoded_image):
+    """Return a Gemini inline-data part for a base64 JPEG.
+
+    The part holds only the size-bounded JPEG bytes, never a decoded PIL
+    image or an open file, so it is released as soon as the request is done.
+    """
+    return {'mime_type': 'image/jpeg', 'data': base64.b64decode(encoded_image)}
+
+
+def panel_labels(count):
+    """Return panel labels "A", "B", ... falling back to numbers past "Z"."""
+    if count <= len(string.ascii_uppercase):
+        return list(string.ascii_uppercase[:count])
+    return [str(index + 1) for index in range(count)]
+
+
+def build_montage(images, max_edge, labels=None, gutter=MONTAGE_GUTTER):
+    """Tile ``images`` into one labelled grid whose longest edge is ``max_edge``."""
+    columns = math.ceil(math.sqrt(len(images)))
+    rows = math.ceil(len(images) / columns)
+    tile_width = max_edge // columns
+    tile_height = max_edge // rows
+    labels = labels or panel_labels(len(images))
+
+    canvas = Image.new('RGB', (tile_width * columns, tile_height * rows))
+    draw = ImageDraw.Draw(canvas)
+    font = ImageFont.load_default(size=max(12, tile_height // 16))
+
+    for index, (image, label) in enumerate(zip(images, labels)):
+        tile = image.convert('RGB')
+        tile.thumbnail(
+            (tile_width - 2 * gutter, tile_height - 2 * gutter), Image.LANCZOS
+        )
+        column, row = index % columns, index // columns
+        left = column * tile_width + (tile_width - tile.width) // 2
+        top = row * tile_height + (tile_height - tile.height) // 2
+        canvas.paste(tile, (left, top))
+
+        text_origin = (column * tile_width + gutter, row * tile_height + gutter)
+        text_box = draw.textbbox(text_origin, label, font=font)
+        draw.rectangle(
+            (text_box[0] - 4, text_box[1] - 4, text_box[2] + 4, text_box[3] + 4),
+            fill='white'
+        )
+        draw.text(text_origin, label, fill='black', font=font)
+
+    return canvas
+
+
+def load_tile(image_path, image_key, max_edge, crop=False):
+    """Open, optionally crop, and shrink one montage tile; None if the image is too small."""
+    with Image.open(image_path) as img:
+        width, height = img.size
+        if width <= MIN_IMAGE_SIZE or height <= MIN_IMAGE_SIZE:
+            return None
+        if crop:
+            img = crop_borders(img, image_key)
+        tile = img.copy()
+    tile.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    return tile
+
+
+def encode_montage(image_paths, provider, crop=False):
+    """Return one base64 montage of a case's images, or None for single-image cases.
+
+    Images at or below ``MIN_IMAGE_SIZE`` are skipped like in the per-image
+    path. The encoded montage is cached, so later tries of the same case
+    only pay for a ``stat`` per source file.
+    """
+    profile = PROVIDER_PROFILES[provider]
+    max_edge = profile['max_edge']
+    image_keys = tuple(file_hash(image_path) for image_path in image_paths)
+    cache_key = (image_keys, provider, crop)
+    if cache_key in _montages:
+        return _montages[cache_key]
+
+    tiles = [
+        tile for tile in map_images(
+            lambda image_path, image_key: load_tile(image_path, image_key, max_edge, crop),
+            image_paths, image_keys
+        )
+        if tile is not None
+    ]
+
+    encoded_montage = None
+    if len(tiles) > 1:
+        encoded_montage = process_and_encode_image(
+            build_montage(tiles, max_edge), max_size=profile['max_bytes']
+        )
+    _montages[cache_key] = encoded_montage
+    return encoded_montage
+
+
+def image_executor():
+    """Return the process-wide image preparation pool, creating it on first use."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=IMAGE_WORKERS, thread_name_prefix='image-prep'
+            )
+    return _executor
+
+
+def map_images(function, *iterables, return_exceptions=False):
+    """Run ``function`` over the inputs on the shared pool, keeping input order.
+
+    With ``return_exceptions`` a failing input yields its exception in place
+    of a result; otherwise the first failure is raised. Single inputs run
+    inline, since the pool would only add overhead.
+    """
+    arguments = list(zip(*iterables))
+    if len(arguments) <= 1:
+        futures = None
+    else:
+        futures = [image_executor().submit(function, *args) for args in arguments]
+
+    results = []
+    for index, args in enumerate(arguments):
+        try:
+            results.append(futures[index].result() if futures else function(*args))
+        except Exception as e:
+            if not return_exceptions:
+                raise
+            results.append(e)
+    return results
+
+
+def encode_image_path(image_path, provider, crop=False):
+    """Open ``image_path`` and encode it with ``encode_image_file``."""
+    with Image.open(image_path) as img:
+        return encode_image_file(image_path, img, provider, crop)
+
+
+def encode_image_paths(image_paths, provider, crop=False, return_exceptions=False):
+    """Encode a case's images concurrently, returning base64 strings in input order."""
+    return map_images(
+        lambda image_path: encode_image_path(image_path, provider, crop),
+        image_paths, return_exceptions=return_exceptions
+    )
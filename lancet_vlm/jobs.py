@@ -0,0 +1,33 @@
+"""Namespaced job keys: one identity per (model, task, prompt, image set, params).
+
+A job key looks like ``gpt-4o/1_rephrased/<sha1>``. The hash covers the
+prompt's content hash, the content hashes of the images actually sent
+and the sampling parameters, so runs of different models or tasks never
+share skip state even when they share a time file or result folder.
+"""
+import hashlib
+import json
+
+JOB_KEY_VERSION = 1
+
+
+def namespace(model, task):
+    return f"{model}/{task}"
+
+
+def image_set_digest(image_manifest, image_paths):
+    """Order-sensitive hash of the images' content, so renamed copies keep their key."""
+    digests = [image_manifest.get(image_path)['sha1'] for image_path in image_paths]
+    return hashlib.sha1('\n'.join(digests).encode('utf-8')).hexdigest()
+
+
+def job_key(model, task, prompt_sha1, image_digest, params):
+    payload = json.dumps({
+        'version': JOB_KEY_VERSION,
+        'model': model,
+        'task': task,
+        'prompt': prompt_sha1,
+        'images': image_digest,
+        'params': params,
+    }, sort_keys=True, separators=(',', ':'))
+    return f"{namespace(model, task)}/{hashlib.sha1(payload.encode('utf-8')).hexdigest()}"
@@ -0,0 +1,249 @@
+"""Append-only execution-time ledger with an in-memory index of finished jobs.
+
+Each run appends one JSON line per request to ``time/<name>.jsonl``, keyed
+by its job key (see ``lancet_vlm.jobs``); later lines for the same key
+replace earlier ones when the ledger is loaded. The legacy
+``time/<name>.xlsx`` file is imported the first time a ledger is opened and
+is still written as an export at the end of a run. Imported rows carry no
+job key; they are stamped with the ``<model>/<task>`` namespace of the
+script that imported them and only skip that script's jobs, matched by
+(case, temperature, try).
+
+Every record is handed to the OS as soon as it is written, so a killed
+process loses nothing; fsync is batched (every ``FSYNC_EVERY`` records or
+``FSYNC_INTERVAL`` seconds, and on exit) to bound what a power loss can drop.
+With a ``lancet_vlm.writer.BackgroundWriter``, records are indexed at once
+and written by the writer thread instead. ``record`` then waits for that
+write, together with the job's result row queued before it (but not for
+traces, cassettes or summaries), so a paid job is on disk before the next
+one starts. A record that could not be written is reported and retried.
+
+Usage (from the repository root):
+
+    python -m lancet_vlm.ledger --owner gpt-4o/1_orig time/OpenAI_gpt4o_execution_times.xlsx
+"""
+import argparse
+import atexit
+import json
+import os
+import time
+
+import pandas as pd
+
+COLUMNS = ('number', 'temperature', 'try', 'time', 'payload_bytes', 'job')
+
+FSYNC_EVERY = 16
+FSYNC_INTERVAL = 5.0
+
+
+def ledger_key(case_number, temperature, try_number):
+    return int(case_number), float(temperature), int(try_number)
+
+
+def record_key(record):
+    if record.get('job'):
+        return record['job']
+    return (record.get('owner'),) + ledger_key(record['number'], record['temperature'], record['try'])
+
+
+def job_owner(job):
+    """gpt-4o/1_orig/<sha1> -> gpt-4o/1_orig"""
+    return job.rsplit('/', 1)[0]
+
+
+def ledger_path(time_file_name):
+    """time/OpenAI_execution_times.xlsx -> time/OpenAI_execution_times.jsonl"""
+    return os.path.splitext(time_file_name)[0] + '.jsonl'
+
+
+def clean_number(value):
+    if value is None or pd.isna(value):
+        return None
+    return value.item() if hasattr(value, 'item') else value
+
+
+class ExecutionLedger:
+    def __init__(self, path, writer=None):
+        self.path = path
+        self.writer = writer
+        self.index = {}
+        self.lines = 0
+        self.torn_tail = False
+        self.ledger_file = None
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        if os.path.exists(path):
+            self.load()
+
+    def load(self):
+        with open(self.path, 'r') as ledger_file:
+            for line in ledger_file:
+                self.torn_tail = not line.endswith('\n')
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A line cut short by a crash; everything before it is intact.
+                    continue
+                self.lines += 1
+                self.index[record_key(record)] = record
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.index.values())
+
+    def get(self, case_number, temperature, try_number, owner=None):
+        """The legacy (job-less) record ``owner`` imported for a case, temperature and try, if any."""
+        return self.index.get((owner,) + ledger_key(case_number, temperature, try_number))
+
+    def has_job(self, job, case_number, temperature, try_number, timed=False):
+        """True if ``job`` is recorded, or a legacy row imported by the job's own model and task covers
+        the same case/temperature/try.
+
+        With ``timed``, the record must also have a time.
+        """
+        record = self.index.get(job)
+        if record is None:
+            record = self.get(case_number, temperature, try_number, job_owner(job))
+        return record is not None and (not timed or record['time'] is not None)
+
+    def open_for_append(self):
+        if self.ledger_file is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self.ledger_file = open(self.path, 'a')
+            atexit.register(self.close)
+            if self.torn_tail:
+                self.ledger_file.write('\n')
+                self.torn_tail = False
+        return self.ledger_file
+
+    def append(self, records):
+        ledger_file = self.open_for_append()
+        for record in records:
+            # One write per line so each record reaches the file whole.
+            ledger_file.write(json.dumps(record) + '\n')
+            self.lines += 1
+            self.unsynced += 1
+            self.index[record_key(record)] = record
+        ledger_file.flush()
+        if self.unsynced >= FSYNC_EVERY or time.monotonic() - self.last_sync >= FSYNC_INTERVAL:
+            self.sync()
+
+    def write_batch(self, records):
+        self.append(records)
+
+    def sync(self):
+        if self.ledger_file is not None and self.unsynced:
+            self.ledger_file.flush()
+            os.fsync(self.ledger_file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        if self.ledger_file is not None:
+            self.sync()
+            self.ledger_file.close()
+            self.ledger_file = None
+            atexit.unregister(self.close)
+
+    def record(self, case_number, temperature, try_number, execution_time, payload_bytes=None, job=None,
+               **fields):
+        number, temperature, try_number = ledger_key(case_number, temperature, try_number)
+        record = {
+            'job': job,
+            'number': number,
+            'temperature': temperature,
+            'try': try_number,
+            'time': execution_time,
+            'payload_bytes': payload_bytes,
+        }
+        record.update(fields)
+        if self.writer is None:
+            self.append([record])
+        else:
+            self.index[record_key(record)] = record
+            self.writer.submit(self, record)
+            if not self.writer.flush(through=self):
+                print(f"Warning: ledger record for case {number} (temperature {temperature}, try {try_number}) "
+                      f"is not on disk yet; it will be written on a later flush")
+        return record
+
+    def import_excel(self, excel_path, owner=None):
+        """Append rows of a legacy time/*.xlsx file that the ledger does not have yet.
+
+        ``owner`` is the ``<model>/<task>`` namespace the rows belong to; rows without one never
+        cause a skip.
+        """
+        df = pd.read_excel(excel_path)
+        records = []
+        for row in df.to_dict('records'):
+            if clean_number(row.get('number')) is None:
+                continue
+            record = {column: clean_number(row.get(column)) for column in COLUMNS}
+            record['number'], record['temperature'], record['try'] = ledger_key(
+                record['number'], record['temperature'], record['try']
+            )
+            record['owner'] = owner
+            if record_key(record) not in self.index:
+                records.append(record)
+        self.append(records)
+        return len(records)
+
+    def to_dataframe(self):
+        rows = sorted(self.index.values(), key=lambda record: (record['temperature'], record['try'], record['number']))
+        columns = list(COLUMNS) + sorted({key for row in rows for key in row} - set(COLUMNS))
+        # Excel cells hold scalars only, so lists such as attempt_times are written as JSON.
+        rows = [
+            {key: json.dumps(value) if isinstance(value, (list, dict)) else value for key, value in row.items()}
+            for row in rows
+        ]
+        return pd.DataFrame(rows, columns=columns)
+
+    def export_excel(self, excel_path):
+        os.makedirs(os.path.dirname(excel_path) or '.', exist_ok=True)
+        self.to_dataframe().to_excel(excel_path, index=False)
+
+    def compact(self):
+        """Rewrite the file with one line per key, dropping superseded entries."""
+        self.close()
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w') as ledger_file:
+            for record in self.index.values():
+                ledger_file.write(json.dumps(record) + '\n')
+            ledger_file.flush()
+            os.fsync(ledger_file.fileno())
+        os.replace(temporary_path, self.path)
+        self.lines = len(self.index)
+
+
+def open_ledger(time_file_name, writer=None, owner=None):
+    """Open the ledger next to ``time_file_name``, importing the Excel file on first use.
+
+    The imported rows are stamped with ``owner``, the namespace of the script that owns the time file.
+    """
+    execution_ledger = ExecutionLedger(ledger_path(time_file_name), writer)
+    if not os.path.exists(execution_ledger.path) and os.path.exists(time_file_name):
+        imported = execution_ledger.import_excel(time_file_name, owner)
+        print(f"Imported {imported} rows from {time_file_name} into {execution_ledger.path}")
+    return execution_ledger
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--owner', help='<model>/<task> of the script that wrote the files, e.g. gpt-4o/1_orig')
+    parser.add_argument('excel_files', nargs='+', help='legacy time/*.xlsx files to import')
+    args = parser.parse_args()
+    if args.owner is None:
+        print("Warning: rows imported without --owner will not skip any jobs")
+    for excel_path in args.excel_files:
+        execution_ledger = ExecutionLedger(ledger_path(excel_path))
+        imported = execution_ledger.import_excel(excel_path, args.owner)
+        execution_ledger.close()
+        print(f"{excel_path}: {imported} new rows, {len(execution_ledger)} in {execution_ledger.path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Structured JSON-lines run logs written off the request thread.
+
+Each analyzer run gets its own file, ``logs/<model>_<task>_<run id>.jsonl``
+in the working directory, so scripts started from the same folder never
+interleave. Records go through a ``QueueHandler``; a ``QueueListener``
+thread formats them as one JSON object per line (time, level, message, run
+id and fields such as job key, error class and timings) and writes them
+to a rotating file that is flushed every ``FLUSH_RECORDS`` records or
+``FLUSH_INTERVAL`` seconds and at exit.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import time
+
+LOG_FOLDER = 'logs'
+MAX_BYTES = 10 * 1024 * 1024
+BACKUP_COUNT = 5
+
+FLUSH_RECORDS = 64
+FLUSH_INTERVAL = 5.0
+
+LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+}
+
+
+class JsonLineFormatter(logging.Formatter):
+    def __init__(self, run_id):
+        super().__init__()
+        self.run_id = run_id
+
+    def format(self, record):
+        entry = {
+            'time': round(record.created, 6),
+            'level': record.levelname.lower(),
+            'run': self.run_id,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class BufferedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Rotating file handler that flushes in batches instead of after every record."""
+
+    def __init__(self, filename, max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+
+    def flush(self):
+        self.unflushed += 1
+        if self.unflushed >= FLUSH_RECORDS or time.monotonic() - self.last_flush >= FLUSH_INTERVAL:
+            self.flush_now()
+
+    def flush_now(self):
+        super().flush()
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.acquire()
+        try:
+            if self.stream is not None:
+                self.flush_now()
+        finally:
+            self.release()
+        super().close()
+
+
+class RunLog:
+    def __init__(self, name, path, run_id):
+        self.path = path
+        self.run_id = run_id
+        self.logger = logging.getLogger(f"lancet_vlm.run.{name}.{run_id}")
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+        record_queue = queue.SimpleQueue()
+        self.logger.addHandler(logging.handlers.QueueHandler(record_queue))
+        self.file_handler = BufferedRotatingFileHandler(path)
+        self.file_handler.setFormatter(JsonLineFormatter(run_id))
+        self.listener = logging.handlers.QueueListener(record_queue, self.file_handler)
+        self.listener.start()
+        atexit.register(self.close)
+
+    def log(self, level, message, **fields):
+        self.logger.log(LEVELS[level], message, extra={'fields': fields})
+
+    def close(self):
+        if self.listener is None:
+            return
+        self.listener.stop()
+        self.listener = None
+        self.file_handler.close()
+        atexit.unregister(self.close)
+
+
+def open_run_log(model, task):
+    run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+    os.makedirs(LOG_FOLDER, exist_ok=True)
+    path = os.path.join(LOG_FOLDER, f"{model}_{task}_{run_id}.jsonl")
+    return RunLog(f"{model}_{task}", path, run_id)
@@ -0,0 +1,142 @@
+import json
+import os
+
+from PIL import Image
+
+from lancet_vlm import imaging
+from lancet_vlm.paths import CACHE_FOLDER, IMAGE_FOLDER
+
+MANIFEST_FILE_NAME = "image_manifest.json"
+
+# Lookup order for quiz file names given without an extension, as in the
+# `jpg` column of Lancet_QnA.xlsx.
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.gif']
+
+
+class ImageManifest:
+    """Header metadata for every image in the quiz folder, indexed for O(1) lookups."""
+
+    def __init__(self, folder, entries):
+        self.folder = folder
+        self.entries = entries
+        self._by_name = {entry['name']: entry for entry in entries}
+        self._by_stem = {}
+        for extension in reversed(IMAGE_EXTENSIONS):
+            for entry in entries:
+                stem, entry_extension = os.path.splitext(entry['name'])
+                if entry_extension.lower() == extension:
+                    self._by_stem[stem] = entry
+
+    def __len__(self):
+        return len(self.entries)
+
+    def path(self, entry):
+        return os.path.join(self.folder, entry['name'])
+
+    def resolve(self, file_name):
+        """Return the path for a quiz file name, trying known extensions, or None."""
+        entry = self._by_name.get(file_name) or self._by_stem.get(file_name)
+        if entry is None:
+            return None
+        return self.path(entry)
+
+    def get(self, image_path):
+        """Return the manifest entry for a path inside the quiz folder, or None."""
+        if os.path.dirname(os.path.abspath(image_path)) != os.path.abspath(self.folder):
+            return None
+        return self._by_name.get(os.path.basename(image_path))
+
+    def is_large_enough(self, entry, min_size=imaging.MIN_IMAGE_SIZE):
+        return entry['width'] > min_size and entry['height'] > min_size
+
+
+def read_entry(dir_entry, previous=None):
+    """Build a manifest entry from the image header, reusing ``previous`` if unchanged."""
+    stat = dir_entry.stat()
+    if (previous is not None and previous['bytes'] == stat.st_size
+            and previous['mtime_ns'] == stat.st_mtime_ns):
+        return previous
+
+    # Image.open only parses the header; pixel data is never decoded here.
+    with Image.open(dir_entry.path) as img:
+        width, height = img.size
+        mode, image_format = img.mode, img.format
+
+    return {
+        'name': dir_entry.name,
+        'width': width,
+        'height': height,
+        'mode': mode,
+        'format': image_format,
+        'bytes': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha1': imaging.file_hash(dir_entry.path),
+    }
+
+
+def scan_folder(folder, previous_entries=None):
+    """Scan ``folder`` once with os.scandir and return its image entries."""
+    previous_entries = previous_entries or {}
+    entries = []
+    with os.scandir(folder) as dir_entries:
+        for dir_entry in dir_entries:
+            extension = os.path.splitext(dir_entry.name)[1].lower()
+            if not dir_entry.is_file() or extension not in IMAGE_EXTENSIONS:
+                continue
+            try:
+                entries.append(read_entry(dir_entry, previous_entries.get(dir_entry.name)))
+            except OSError as e:
+                print(f"Error reading image header {dir_entry.path}: {e}")
+    entries.sort(key=lambda entry: entry['name'])
+    return entries
+
+
+def manifest_path(folder):
+    return os.path.join(CACHE_FOLDER, f"{os.path.basename(folder)}_{MANIFEST_FILE_NAME}")
+
+
+def read_cached_entries(cache_path):
+    """Entries of a persisted manifest keyed by file name, or {} if there is none."""
+    if not os.path.exists(cache_path):
+        return {}
+    with open(cache_path, 'r') as manifest_file:
+        return {entry['name']: entry for entry in json.load(manifest_file)['entries']}
+
+
+def build_manifest(folder=IMAGE_FOLDER, force_write=False):
+    """Rescan ``folder``, reusing hashes of files whose size and mtime are unchanged.
+
+    The manifest is persisted when an entry changed (or ``force_write``).
+    """
+    cache_path = manifest_path(folder)
+    previous_entries = read_cached_entries(cache_path)
+    entries = scan_folder(folder, previous_entries)
+
+    if force_write or entries != sorted(previous_entries.values(), key=lambda entry: entry['name']):
+        os.makedirs(CACHE_FOLDER, exist_ok=True)
+        temporary_path = cache_path + '.tmp'
+        with open(temporary_path, 'w') as manifest_file:
+            json.dump({'entries': entries}, manifest_file)
+        os.replace(temporary_path, cache_path)
+        print(f"Image manifest saved to {cache_path} ({len(entries)} images)")
+
+    manifest = ImageManifest(folder, entries)
+    for entry in manifest.entries:
+        imaging.remember_file_hash(manifest.path(entry), entry['bytes'], entry['mtime_ns'], entry['sha1'])
+    return manifest
+
+
+def load_manifest(folder=IMAGE_FOLDER):
+    """Return the folder's manifest, stat-ing every file so images replaced in place are re-read.
+
+    A file rewritten in place leaves the folder's mtime unchanged, so the
+    folder mtime alone cannot tell whether a cached entry is still valid.
+    """
+    if not os.path.isdir(folder):
+        print(f"Warning: Image folder not found: {folder}")
+        return ImageManifest(folder, [])
+    return build_manifest(folder)
+
+
+if __name__ == "__main__":
+    build_manifest(force_write=True)
@@ -0,0 +1,205 @@
+"""OpenMetrics counters and histograms for a running sweep.
+
+Each analyzer reports one observation per job, built from its ``JobTimer``
+and ``JobUsage``: requests, retries by reason, refusals, JSON parse
+failures, request latency, tokens and uploaded bytes, labelled by provider,
+model and task. The registry is written to ``metrics/<model>_<task>.prom``
+every ``EXPORT_INTERVAL`` seconds and at exit. Set ``LANCET_METRICS_PORT``
+to also serve it at ``http://127.0.0.1:<port>/metrics`` for a local
+Prometheus to scrape.
+"""
+import atexit
+import http.server
+import os
+import threading
+import time
+
+METRICS_FOLDER = 'metrics'
+EXPORT_INTERVAL = 10.0
+
+# Environment variable holding the local HTTP port, e.g. "9464".
+METRICS_PORT_ENV = 'LANCET_METRICS_PORT'
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.values = {}
+
+    def inc(self, labels, amount=1):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# TYPE {self.name} counter", f"# HELP {self.name} {self.help_text}"]
+        for labels, value in sorted(self.values.items()):
+            lines.append(f"{self.name}_total{format_labels(labels)} {format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+    def observe(self, labels, value):
+        key = tuple(sorted(labels.items()))
+        if key not in self.values:
+            self.values[key] = {'buckets': [0] * len(self.buckets), 'count': 0, 'sum': 0.0}
+        series = self.values[key]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series['buckets'][i] += 1
+        series['count'] += 1
+        series['sum'] += value
+
+    def render(self):
+        lines = [f"# TYPE {self.name} histogram", f"# HELP {self.name} {self.help_text}"]
+        for labels, series in sorted(self.values.items()):
+            for bound, bucket_count in zip(self.buckets, series['buckets']):
+                bucket_labels = labels + (('le', format_value(float(bound))),)
+                lines.append(f"{self.name}_bucket{format_labels(bucket_labels)} {bucket_count}")
+            lines.append(f"{self.name}_bucket{format_labels(labels + (('le', '+Inf'),))} {series['count']}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {series['count']}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {format_value(series['sum'])}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = Counter('lancet_jobs', 'Jobs finished, by outcome.')
+        self.requests = Counter('lancet_requests', 'API requests sent, including retries.')
+        self.retries = Counter('lancet_retries', 'Retried attempts, by error class or reason.')
+        self.refusals = Counter('lancet_refusals', "Refused responses, retried.")
+        self.parse_failures = Counter('lancet_json_parse_failures', 'Responses without a parsable JSON object.')
+        self.tokens = Counter('lancet_tokens', 'Tokens sent or received, by kind.')
+        self.upload_bytes = Counter('lancet_upload_bytes', 'Encoded image bytes uploaded, counting every attempt.')
+        self.latency = Histogram('lancet_request_latency_seconds', 'Latency of each API attempt.')
+        self.job_duration = Histogram('lancet_job_duration_seconds', 'Wall-clock time per job.')
+        self.families = [
+            self.jobs, self.requests, self.retries, self.refusals, self.parse_failures, self.tokens,
+            self.upload_bytes, self.latency, self.job_duration,
+        ]
+
+    def render(self):
+        with self.lock:
+            lines = [line for family in self.families for line in family.render()]
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class JobMetrics:
+    """Observations for one provider/model/task, exported from a shared registry."""
+
+    def __init__(self, provider, model, task, registry=REGISTRY, path=None):
+        self.labels = {'provider': provider, 'model': model, 'task': task}
+        self.registry = registry
+        self.path = path or os.path.join(METRICS_FOLDER, f"{model}_{task}.prom")
+        self.last_export = 0.0
+        atexit.register(self.export)
+
+    def observe_job(self, timer, outcome, payload_bytes=None, prompt_tokens=None, usage=None):
+        registry = self.registry
+        labels = self.labels
+        with registry.lock:
+            registry.jobs.inc(dict(labels, outcome=outcome))
+            attempts = 0
+            for span in timer.spans:
+                if span['name'] != 'network':
+                    continue
+                attempts += 1
+                registry.requests.inc(labels)
+                registry.latency.observe(labels, span['duration'])
+                if span.get('error'):
+                    registry.retries.inc(dict(labels, reason=span['error']))
+            for event, reason in (('refusals', 'refusal'), ('parse_failures', 'parse_failure'),
+                                  ('empty_responses', 'empty_response')):
+                if timer.events.get(event):
+                    registry.retries.inc(dict(labels, reason=reason), timer.events[event])
+            if timer.events.get('refusals'):
+                registry.refusals.inc(labels, timer.events['refusals'])
+            if timer.events.get('parse_failures'):
+                registry.parse_failures.inc(labels, timer.events['parse_failures'])
+            if usage is not None and usage.requests:
+                for kind in ('input', 'output', 'cached', 'cache_write'):
+                    registry.tokens.inc(dict(labels, kind=kind), getattr(usage, f"{kind}_tokens"))
+                registry.tokens.inc(dict(labels, kind='image_estimate'), usage.image_tokens_per_request * usage.requests)
+            elif prompt_tokens:
+                registry.tokens.inc(dict(labels, kind='prompt_estimate'), prompt_tokens * attempts)
+            if payload_bytes:
+                registry.upload_bytes.inc(labels, payload_bytes * attempts)
+            registry.job_duration.observe(labels, time.perf_counter() - timer.clock_start)
+        if time.monotonic() - self.last_export >= EXPORT_INTERVAL:
+            self.export()
+
+    def export(self):
+        """Write the registry atomically so a textfile collector never reads half a file."""
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w') as metrics_file:
+            metrics_file.write(self.registry.render())
+        os.replace(temporary_path, self.path)
+        self.last_export = time.monotonic()
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+
+
+def serve(port, host='127.0.0.1'):
+    """Serve the shared registry over HTTP from a daemon thread (once per process)."""
+    global _server
+    if _server is None:
+        _server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=_server.serve_forever, name='lancet-metrics', daemon=True).start()
+        print(f"Serving metrics at http://{host}:{port}/metrics")
+    return _server
+
+
+def open_metrics(provider, model, task):
+    port = os.getenv(METRICS_PORT_ENV)
+    if port:
+        serve(int(port))
+    return JobMetrics(provider, model, task)
@@ -0,0 +1,395 @@
+"""Local stand-in for the OpenAI, Anthropic and Gemini APIs, for load tests.
+
+One port serves OpenAI chat completions (``/v1/chat/completions``), Anthropic
+messages (``/v1/messages``) and Gemini ``generateContent``
+(``/v1beta/models/<model>:generateContent``) in their wire formats. Each
+request waits for a latency drawn from ``--latency`` and is answered with a
+JSON object filled in from the output format in the prompt or, at the
+configured rates, with a 429 or 500 error, an ``image_parse_error``, refusal
+text or malformed JSON. ``--rpm`` enforces a requests-per-minute limit per
+provider and reports it in the provider's rate-limit headers. Images that
+Pillow cannot open and verify are rejected with a 400 ``image_parse_error``,
+as the real APIs reject them.
+
+Malformed JSON exercises the runners' parse-failure paths: Gemini retries
+the request, while the GPT and Claude runners keep the raw answer and
+count it in ``lancet_json_parse_failures``.
+
+Analyzers use the server when ``LANCET_BASE_URL`` is set; the API keys in
+``.env`` can be placeholders.
+
+Usage:
+
+    python -m lancet_vlm.mock_server --latency lognormal:2,0.5 --rate-429 0.05 --refusal 0.02
+    LANCET_BASE_URL=http://127.0.0.1:8600 python 1.1.2.gpt-4o_orig.py
+"""
+import argparse
+import base64
+import binascii
+import collections
+import datetime
+import http.server
+import io
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+import uuid
+
+from PIL import Image
+
+# Environment variable pointing the analyzers' API clients at this server.
+BASE_URL_ENV = 'LANCET_BASE_URL'
+DEFAULT_PORT = 8600
+
+GEMINI_PATH = re.compile(r'^/v1(?:beta)?/models/([^/:]+):generateContent$')
+
+REFUSAL_TEXT = "I'm sorry, but I can't help with that request."
+
+# Rough input tokens per image reported in the mock usage.
+IMAGE_TOKENS = {'openai': 765, 'anthropic': 1600, 'gemini': 258}
+
+# Injected outcomes, drawn in this order from one roll per request.
+FAULTS = ('rate_limit', 'server_error', 'image_parse_error', 'refusal', 'malformed_json')
+ERROR_STATUS = {'rate_limit': 429, 'server_error': 500, 'image_parse_error': 400}
+
+OPENAI_ERRORS = {
+    'rate_limit': ('Rate limit reached for requests. Please try again later.', 'requests', 'rate_limit_exceeded'),
+    'server_error': ('The server had an error while processing your request.', 'server_error', None),
+    'image_parse_error': ('Invalid image.', 'invalid_request_error', 'image_parse_error'),
+}
+ANTHROPIC_ERRORS = {
+    'rate_limit': ('rate_limit_error', 'Number of requests has exceeded your per-minute rate limit'),
+    'server_error': ('api_error', 'Internal server error'),
+    'image_parse_error': ('invalid_request_error', 'image_parse_error: Could not process image'),
+}
+GEMINI_ERRORS = {
+    'rate_limit': ('RESOURCE_EXHAUSTED', 'Resource has been exhausted (e.g. check quota).'),
+    'server_error': ('INTERNAL', 'An internal error has occurred.'),
+    'image_parse_error': ('INVALID_ARGUMENT', 'image_parse_error: Unable to process input image.'),
+}
+
+
+def client_kwargs(provider):
+    """Keyword arguments pointing a provider's client at ``LANCET_BASE_URL``; empty when it is unset."""
+    base_url = os.getenv(BASE_URL_ENV)
+    if not base_url:
+        return {}
+    base_url = base_url.rstrip('/')
+    if provider == 'openai':
+        return {'base_url': base_url + '/v1'}
+    if provider == 'anthropic':
+        return {'base_url': base_url}
+    return {'transport': 'rest', 'client_options': {'api_endpoint': base_url}}
+
+
+def parse_latency(spec):
+    """``fixed:S``, ``uniform:LOW,HIGH``, ``lognormal:MEDIAN,SIGMA`` or ``exponential:MEAN``, in seconds."""
+    name, _, params = spec.partition(':')
+    try:
+        values = [float(value) for value in params.split(',')] if params else []
+    except ValueError:
+        values = []
+    if name == 'fixed' and len(values) == 1:
+        return lambda rng: values[0]
+    if name == 'uniform' and len(values) == 2:
+        return lambda rng: rng.uniform(*values)
+    if name == 'lognormal' and len(values) == 2:
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+    if name == 'exponential' and len(values) == 1:
+        return lambda rng: rng.expovariate(1 / values[0])
+    raise argparse.ArgumentTypeError(f"Unknown latency distribution {spec!r}")
+
+
+def request_parts(provider, body):
+    """Prompt text and base64 images of the last message in a request body."""
+    texts = []
+    images = []
+    if provider == 'gemini':
+        contents = body.get('contents') or [{}]
+        for part in contents[-1].get('parts', []):
+            inline_data = part.get('inlineData') or part.get('inline_data')
+            if 'text' in part:
+                texts.append(part['text'])
+            elif inline_data:
+                images.append(inline_data.get('data', ''))
+        return '\n'.join(texts), images
+    messages = body.get('messages') or [{}]
+    content = messages[-1].get('content', '')
+    if isinstance(content, str):
+        return content, images
+    for block in content:
+        if block.get('type') == 'text':
+            texts.append(block['text'])
+        elif block.get('type') == 'image_url':
+            images.append(block['image_url']['url'].partition('base64,')[2])
+        elif block.get('type') == 'image':
+            images.append(block.get('source', {}).get('data', ''))
+    return '\n'.join(texts), images
+
+
+def images_decode(images):
+    """True if every base64 image decodes and Pillow can parse and verify it as an image."""
+    try:
+        for image in images:
+            with Image.open(io.BytesIO(base64.b64decode(image, validate=True))) as img:
+                img.verify()
+    except (binascii.Error, ValueError, OSError, SyntaxError):
+        return False
+    return True
+
+
+def answer_for(prompt_text, rng):
+    """A JSON answer with the keys of the last JSON object in the prompt's output format."""
+    templates = re.findall(r'\{[^{}]*\}', prompt_text)
+    keys = re.findall(r'"([^"]+)"\s*:', templates[-1]) if templates else []
+    answer = {
+        key: str(rng.randint(1, 5)) if key == 'answer' else f"Mock {key}"
+        for key in keys or ('answer', 'reason')
+    }
+    return json.dumps(answer)
+
+
+def openai_body(model, text, input_tokens, output_tokens):
+    return {
+        'id': f"chatcmpl-{uuid.uuid4().hex[:24]}",
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{
+            'index': 0,
+            'message': {'role': 'assistant', 'content': text},
+            'logprobs': None,
+            'finish_reason': 'stop',
+        }],
+        'usage': {
+            'prompt_tokens': input_tokens,
+            'completion_tokens': output_tokens,
+            'total_tokens': input_tokens + output_tokens,
+        },
+    }
+
+
+def anthropic_body(model, text, input_tokens, output_tokens):
+    return {
+        'id': f"msg_{uuid.uuid4().hex[:24]}",
+        'type': 'message',
+        'role': 'assistant',
+        'model': model,
+        'content': [{'type': 'text', 'text': text}],
+        'stop_reason': 'end_turn',
+        'stop_sequence': None,
+        'usage': {'input_tokens': input_tokens, 'output_tokens': output_tokens},
+    }
+
+
+def gemini_body(model, text, input_tokens, output_tokens):
+    return {
+        'candidates': [{
+            'content': {'parts': [{'text': text}], 'role': 'model'},
+            'finishReason': 'STOP',
+            'index': 0,
+        }],
+        'usageMetadata': {
+            'promptTokenCount': input_tokens,
+            'candidatesTokenCount': output_tokens,
+            'totalTokenCount': input_tokens + output_tokens,
+        },
+    }
+
+
+BODIES = {'openai': openai_body, 'anthropic': anthropic_body, 'gemini': gemini_body}
+
+
+def error_body(provider, fault):
+    if provider == 'openai':
+        message, error_type, code = OPENAI_ERRORS[fault]
+        return {'error': {'message': message, 'type': error_type, 'param': None, 'code': code}}
+    if provider == 'anthropic':
+        error_type, message = ANTHROPIC_ERRORS[fault]
+        return {'type': 'error', 'error': {'type': error_type, 'message': message}}
+    status, message = GEMINI_ERRORS[fault]
+    return {'error': {'code': ERROR_STATUS[fault], 'message': message, 'status': status}}
+
+
+def rate_limit_headers(provider, limit, remaining, reset):
+    if provider == 'openai':
+        return {
+            'x-ratelimit-limit-requests': limit,
+            'x-ratelimit-remaining-requests': remaining,
+            'x-ratelimit-reset-requests': f"{reset:.3f}s",
+        }
+    if provider == 'anthropic':
+        reset_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=reset)
+        return {
+            'anthropic-ratelimit-requests-limit': limit,
+            'anthropic-ratelimit-requests-remaining': remaining,
+            'anthropic-ratelimit-requests-reset': reset_at.isoformat(timespec='seconds').replace('+00:00', 'Z'),
+        }
+    return {}
+
+
+class Scenario:
+    """Latency distribution, fault rates and rate limit shared by all request threads."""
+
+    def __init__(self, latency, rates, rpm=0, seed=None):
+        self.latency = latency
+        self.rates = rates
+        self.rpm = rpm
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.windows = collections.defaultdict(collections.deque)
+        self.outcomes = collections.Counter()
+
+    def admit(self, provider):
+        """Whether a request fits in the one-minute window, the slots left and seconds until one frees."""
+        if not self.rpm:
+            return True, None, 0.0
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows[provider]
+            while window and now - window[0] >= 60:
+                window.popleft()
+            if len(window) >= self.rpm:
+                return False, 0, 60 - (now - window[0])
+            window.append(now)
+            return True, self.rpm - len(window), 60 - (now - window[0])
+
+    def fault(self):
+        with self.lock:
+            roll = self.rng.random()
+        for fault in FAULTS:
+            rate = self.rates.get(fault, 0.0)
+            if roll < rate:
+                return fault
+            roll -= rate
+        return None
+
+    def delay(self):
+        with self.lock:
+            return max(0.0, self.latency(self.rng))
+
+    def answer(self, prompt_text):
+        with self.lock:
+            return answer_for(prompt_text, self.rng)
+
+    def count(self, provider, outcome):
+        with self.lock:
+            self.outcomes[(provider, outcome)] += 1
+
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    # Keep connections open like the real APIs, so the SDKs' connection pools are exercised.
+    protocol_version = 'HTTP/1.1'
+    scenario = None
+
+    def do_POST(self):
+        # Read the whole body before any reply, so a keep-alive connection stays in sync.
+        raw_body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        path = self.path.split('?', 1)[0]
+        gemini_match = GEMINI_PATH.match(path)
+        if path.endswith('/chat/completions'):
+            provider = 'openai'
+        elif path.endswith('/messages'):
+            provider = 'anthropic'
+        elif gemini_match:
+            provider = 'gemini'
+        else:
+            self.send_json(404, {'error': {'message': f"Unknown path {path}"}})
+            return
+        try:
+            body = json.loads(raw_body or b'{}')
+        except ValueError:
+            self.send_json(400, {'error': {'message': 'Request body is not JSON'}})
+            return
+        model = gemini_match.group(1) if gemini_match else body.get('model', 'mock')
+        self.respond(provider, model, body)
+
+    def respond(self, provider, model, body):
+        scenario = self.scenario
+        allowed, remaining, reset = scenario.admit(provider)
+        headers = rate_limit_headers(provider, scenario.rpm, remaining, reset) if scenario.rpm else {}
+        prompt_text, images = request_parts(provider, body)
+        fault = scenario.fault() if allowed else 'rate_limit'
+        if fault is None and not images_decode(images):
+            fault = 'image_parse_error'
+        scenario.count(provider, fault or 'ok')
+        if fault in ERROR_STATUS:
+            if fault == 'rate_limit':
+                headers['retry-after'] = max(1, math.ceil(reset))
+            self.send_json(ERROR_STATUS[fault], error_body(provider, fault), headers)
+            return
+        time.sleep(scenario.delay())
+        if fault == 'refusal':
+            text = REFUSAL_TEXT
+        else:
+            text = scenario.answer(prompt_text)
+            if fault == 'malformed_json':
+                text = text[:len(text) // 2]
+        input_tokens = math.ceil(len(prompt_text) / 4) + IMAGE_TOKENS[provider] * len(images)
+        output_tokens = math.ceil(len(text) / 4)
+        self.send_json(200, BODIES[provider](model, text, input_tokens, output_tokens), headers)
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(scenario, port=DEFAULT_PORT, host='127.0.0.1'):
+    handler = type('ScenarioHandler', (MockHandler,), {'scenario': scenario})
+    return http.server.ThreadingHTTPServer((host, port), handler)
+
+
+def print_outcomes(outcomes):
+    for (provider, outcome), count in sorted(outcomes.items()):
+        print(f"{provider:<10}{outcome:<20}{count:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--latency', type=parse_latency, default='lognormal:1.5,0.4',
+                        help='fixed:S, uniform:LOW,HIGH, lognormal:MEDIAN,SIGMA or exponential:MEAN (seconds)')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='share of requests answered with 429')
+    parser.add_argument('--rate-500', type=float, default=0.0, help='share of requests answered with 500')
+    parser.add_argument('--image-parse-error', type=float, default=0.0,
+                        help='share of requests rejected with image_parse_error')
+    parser.add_argument('--refusal', type=float, default=0.0, help="share of answers that are refusal text")
+    parser.add_argument('--malformed-json', type=float, default=0.0, help='share of answers cut off mid-JSON (counted as parse failures by the runners)')
+    parser.add_argument('--rpm', type=int, default=0, help='requests per minute per provider (0 for no limit)')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    rates = {
+        'rate_limit': args.rate_429,
+        'server_error': args.rate_500,
+        'image_parse_error': args.image_parse_error,
+        'refusal': args.refusal,
+        'malformed_json': args.malformed_json,
+    }
+    scenario = Scenario(args.latency, rates, args.rpm, args.seed)
+    server = make_server(scenario, args.port, args.host)
+    print(f"Mock provider server at http://{args.host}:{args.port} (set {BASE_URL_ENV} to this URL)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print_outcomes(scenario.outcomes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+import os
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMAGE_FOLDER = os.path.join(REPO_ROOT, "Lancet_IMAGE240508")
+CACHE_FOLDER = os.path.join(REPO_ROOT, "cache")
+WORKBOOK_PATH = os.path.join(REPO_ROOT, "Lancet_QnA.xlsx")
@@ -0,0 +1,193 @@
+"""Per-variant prompt store: every (case, variant) prompt is rendered once per run.
+
+Prompts are rendered from the analyzer's own ``generate_prompt`` template
+when their case first comes up, whitespace-normalised, hashed and given a
+rough token estimate. Startup cost does not grow with the corpus. At exit the
+prompts rendered in the run are merged into
+``cache/prompts/<variant>_<template>.json`` so runs of different models on
+the same template can be matched by prompt hash.
+
+The lines of the template before the case text are the same for every case.
+``cached_text_blocks`` sends them as their own content block ahead of the
+case text (and the images after it). Anthropic only caches prefixes of
+``ANTHROPIC_MIN_CACHE_TOKENS`` or more, so the block is marked for prompt
+caching only when it is that long; shorter markers would never be read.
+"""
+import atexit
+import hashlib
+import json
+import math
+import os
+
+from lancet_vlm.paths import CACHE_FOLDER
+
+PROMPT_CACHE_FOLDER = os.path.join(CACHE_FOLDER, "prompts")
+
+# Rough characters-per-token ratio for English prompts; only used for estimates.
+CHARS_PER_TOKEN = 4
+
+SYMPTOM_PLACEHOLDER = "{symptom_text}"
+
+# Beta header that enables cache_control markers on Anthropic messages.
+ANTHROPIC_PROMPT_CACHING_BETA = "prompt-caching-2024-07-31"
+# Shortest prefix Anthropic caches for Claude 3 Opus and 3.5 Sonnet.
+ANTHROPIC_MIN_CACHE_TOKENS = 1024
+
+# Task variant -> the symptom text each analyzer passes to generate_prompt.
+SYMPTOM_TEXT = {
+    'orig': lambda case: f"symptom: {case.question}",
+    'rephrased': lambda case: f"symptom: {case.new_q} {case.new_c}",
+    'describe': lambda case: f"symptom: {case.question}",
+}
+
+
+def normalise_whitespace(text):
+    """Drop the template's source indentation, trailing spaces and repeated blank lines."""
+    lines = text.strip('\n').splitlines()
+    first = next((line for line in lines if line.strip()), '')
+    indent = ' ' * (len(first) - len(first.lstrip(' ')))
+    normalised = []
+    for line in lines:
+        if line.startswith(indent):
+            line = line[len(indent):]
+        line = line.rstrip()
+        if line or (normalised and normalised[-1]):
+            normalised.append(line)
+    return '\n'.join(normalised).strip()
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def static_prefix(template):
+    """Whole lines of a normalised template before the case text; all of it if it has no case text."""
+    position = template.find(SYMPTOM_PLACEHOLDER)
+    if position < 0:
+        return template
+    return template[:template.rfind('\n', 0, position) + 1]
+
+
+def split_static(text, prefix):
+    """A prompt as (static prefix, case text); the prefix is empty if the prompt does not start with it."""
+    if prefix and text.startswith(prefix):
+        return prefix, text[len(prefix):]
+    return '', text
+
+
+def cached_text_blocks(text, prefix):
+    """Anthropic text blocks for a prompt, the static prefix first, marked if it is long enough to cache."""
+    static, case_text = split_static(text, prefix)
+    blocks = []
+    if static:
+        block = {"type": "text", "text": static}
+        if estimate_tokens(static) >= ANTHROPIC_MIN_CACHE_TOKENS:
+            block["cache_control"] = {"type": "ephemeral"}
+        blocks.append(block)
+    if case_text:
+        blocks.append({"type": "text", "text": case_text})
+    return blocks
+
+
+def cache_headers(content):
+    """The prompt-caching beta header if a block of ``content`` carries ``cache_control``, else None."""
+    if any('cache_control' in block for block in content):
+        return {"anthropic-beta": ANTHROPIC_PROMPT_CACHING_BETA}
+    return None
+
+
+class Prompt:
+    __slots__ = ('text', 'sha1', 'tokens')
+
+    def __init__(self, text, sha1=None, tokens=None):
+        self.text = text
+        self.sha1 = sha1 or text_hash(text)
+        self.tokens = tokens if tokens is not None else estimate_tokens(text)
+
+    def __repr__(self):
+        return f"Prompt(sha1={self.sha1[:12]!r}, tokens={self.tokens!r})"
+
+
+class PromptStore:
+    def __init__(self, variant, template_sha1, render, static_prefix=''):
+        self.variant = variant
+        self.template_sha1 = template_sha1
+        self.render = render
+        self.prompts = {}
+        self.static_prefix = static_prefix
+
+    @property
+    def name(self):
+        return f"{self.variant}_{self.template_sha1[:12]}"
+
+    @property
+    def path(self):
+        return os.path.join(PROMPT_CACHE_FOLDER, f"{self.name}.json")
+
+    def get(self, case):
+        """The prompt for ``case``, rendered on its first request and reused by later tries."""
+        if case.number not in self.prompts:
+            self.prompts[case.number] = Prompt(self.render(case))
+        return self.prompts[case.number]
+
+    def __len__(self):
+        return len(self.prompts)
+
+    def to_json(self, saved_prompts=None):
+        return {
+            'variant': self.variant,
+            'template_sha1': self.template_sha1,
+            'prompts': {
+                **(saved_prompts or {}),
+                **{
+                    str(case_number): {'sha1': prompt.sha1, 'tokens': prompt.tokens, 'text': prompt.text}
+                    for case_number, prompt in self.prompts.items()
+                },
+            },
+        }
+
+    def save(self):
+        """Merge the prompts rendered so far into the file, unless it already has them all."""
+        if not self.prompts:
+            return
+        saved = None
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as store_file:
+                saved = json.load(store_file)
+        data = self.to_json(saved['prompts'] if saved else None)
+        if data == saved:
+            return
+        os.makedirs(PROMPT_CACHE_FOLDER, exist_ok=True)
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w') as store_file:
+            json.dump(data, store_file)
+        os.replace(temporary_path, self.path)
+
+    def close(self):
+        if self.prompts:
+            self.save()
+            print(self.summary())
+        atexit.unregister(self.close)
+
+    def summary(self):
+        distinct = len({prompt.sha1 for prompt in self.prompts.values()})
+        tokens = sum(prompt.tokens for prompt in self.prompts.values())
+        return (f"Prompt store {self.name}: {len(self)} prompts, {distinct} distinct, "
+                f"~{tokens} tokens, ~{estimate_tokens(self.static_prefix)} in the static prefix")
+
+
+def build_store(variant, generate_prompt):
+    """A store that renders ``generate_prompt`` for each case of a task variant as it is needed."""
+    template = normalise_whitespace(generate_prompt(SYMPTOM_PLACEHOLDER))
+    symptom_text = SYMPTOM_TEXT[variant]
+
+    def render(case):
+        return normalise_whitespace(generate_prompt(symptom_text(case)))
+
+    store = PromptStore(variant, text_hash(template), render, static_prefix(template))
+    atexit.register(store.close)
+    return store
@@ -0,0 +1,157 @@
+"""One SQLite result store per working directory, keyed by job.
+
+Each request's raw response, parsed JSON fields, usage, latency and status
+are stored in ``results.sqlite`` (WAL mode, so commits do not wait for a
+disk sync). The legacy ``<case>.txt`` folders and ``analysis_results.xlsx``
+files read by ``excel_combined_sum.py`` are regenerated on demand. With a
+``lancet_vlm.writer.BackgroundWriter``, ``put`` only queues the row and the
+writer thread commits rows in batches.
+
+Usage (from the folder the analyzers were run in):
+
+    python -m lancet_vlm.results export [--folder gpt4o_result/gpt4o_result_temp_0_try1]
+"""
+import argparse
+import json
+import os
+import sqlite3
+import time
+
+import pandas as pd
+
+RESULT_STORE_PATH = 'results.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    job TEXT PRIMARY KEY,
+    model TEXT,
+    task TEXT,
+    case_number INTEGER,
+    temperature REAL,
+    try INTEGER,
+    legacy_path TEXT,
+    status TEXT,
+    raw TEXT,
+    parsed TEXT,
+    usage TEXT,
+    latency REAL,
+    created REAL
+);
+CREATE INDEX IF NOT EXISTS results_case ON results (model, task, case_number);
+CREATE INDEX IF NOT EXISTS results_legacy_path ON results (legacy_path);
+"""
+
+COLUMNS = (
+    'job', 'model', 'task', 'case_number', 'temperature', 'try', 'legacy_path',
+    'status', 'raw', 'parsed', 'usage', 'latency', 'created',
+)
+
+
+def parse_json(raw):
+    """The response's JSON object, or None if it is not valid JSON."""
+    if raw is None:
+        return None
+    try:
+        parsed = json.loads(raw)
+    except (json.JSONDecodeError, TypeError):
+        return None
+    return parsed if isinstance(parsed, dict) else None
+
+
+def make_row(job, legacy_path, case_number, temperature, try_number, raw, status='ok', latency=None,
+             usage=None):
+    model, task, _ = job.split('/', 2)
+    parsed = parse_json(raw)
+    return (
+        job, model, task, int(case_number), float(temperature), int(try_number), legacy_path,
+        status, raw, json.dumps(parsed) if parsed is not None else None,
+        json.dumps(usage) if usage is not None else None, latency, time.time(),
+    )
+
+
+class ResultStore:
+    def __init__(self, path=RESULT_STORE_PATH, writer=None):
+        self.path = path
+        self.writer = writer
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+
+    def put_many(self, rows):
+        with self.connection:
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO results ({', '.join(COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(COLUMNS))})",
+                rows,
+            )
+
+    def write_batch(self, rows):
+        self.put_many(rows)
+
+    def put(self, job, legacy_path, case_number, temperature, try_number, raw, status='ok', latency=None,
+            usage=None):
+        row = make_row(job, legacy_path, case_number, temperature, try_number, raw, status, latency, usage)
+        if self.writer is None:
+            self.put_many([row])
+        else:
+            self.writer.submit(self, row)
+
+    def has(self, job):
+        return self.connection.execute('SELECT 1 FROM results WHERE job = ?', (job,)).fetchone() is not None
+
+    def rows(self, folder=None):
+        query = f"SELECT {', '.join(COLUMNS)} FROM results"
+        params = ()
+        if folder is not None:
+            prefix = os.path.join(folder, '')
+            query += " WHERE substr(legacy_path, 1, ?) = ?"
+            params = (len(prefix), prefix)
+        query += " ORDER BY case_number"
+        for values in self.connection.execute(query, params):
+            yield dict(zip(COLUMNS, values))
+
+    def close(self):
+        self.connection.close()
+
+
+def export_legacy(store, folder=None):
+    """Write ``<case>.txt`` and ``analysis_results.xlsx`` for every stored result (or one folder)."""
+    parsed_by_folder = {}
+    written = 0
+    for row in store.rows(folder):
+        result_folder = os.path.dirname(row['legacy_path'])
+        os.makedirs(result_folder or '.', exist_ok=True)
+        parsed_rows = parsed_by_folder.setdefault(result_folder, [])
+        if row['status'] != 'ok' or row['raw'] is None:
+            continue
+        with open(row['legacy_path'], 'w') as result_file:
+            result_file.write(row['raw'])
+        written += 1
+        if row['parsed'] is not None:
+            parsed_rows.append({'case_number': row['case_number'], **json.loads(row['parsed'])})
+
+    for result_folder, parsed_rows in parsed_by_folder.items():
+        excel_path = os.path.join(result_folder, 'analysis_results.xlsx')
+        pd.DataFrame(parsed_rows).to_excel(excel_path, index=False)
+    print(f"Exported {written} results into {len(parsed_by_folder)} folders")
+
+
+def open_store(path=RESULT_STORE_PATH, writer=None):
+    return ResultStore(path, writer)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', choices=['export'])
+    parser.add_argument('--store', default=RESULT_STORE_PATH)
+    parser.add_argument('--folder', help='only export results under this result folder')
+    args = parser.parse_args()
+    store = open_store(args.store)
+    export_legacy(store, args.folder)
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""Streaming latency statistics per model and temperature.
+
+``LatencyStats`` keeps a Welford mean/variance and a log-bucketed histogram
+(relative error ``RELATIVE_ERROR``), so each update costs O(1) and p50/p90/p99
+are read from at most a few hundred buckets instead of re-sorting every
+sample. Two accumulators merge exactly, so statistics from several workers
+or ledgers can be combined.
+
+Usage (from the folder the analyzers were run in):
+
+    python -m lancet_vlm.stats time/*.jsonl
+"""
+import argparse
+import math
+import os
+
+from lancet_vlm import ledger
+
+RELATIVE_ERROR = 0.01
+
+# Latencies below this many seconds share the lowest bucket.
+MIN_LATENCY = 1e-3
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class LatencyStats:
+    def __init__(self, relative_error=RELATIVE_ERROR):
+        self.relative_error = relative_error
+        self.gamma = (1 + relative_error) / (1 - relative_error)
+        self.log_gamma = math.log(self.gamma)
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = {}
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        index = math.ceil(math.log(max(value, MIN_LATENCY)) / self.log_gamma)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def merge(self, other):
+        if other.relative_error != self.relative_error:
+            raise ValueError("Cannot merge latency stats with different relative errors")
+        if not other.count:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        for index, bucket_count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + bucket_count
+        return self
+
+    @property
+    def stdev(self):
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                value = 2 * self.gamma ** index / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            'relative_error': self.relative_error,
+            'count': self.count,
+            'mean': self.mean,
+            'm2': self.m2,
+            'min': self.min,
+            'max': self.max,
+            'buckets': {str(index): count for index, count in self.buckets.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls(data['relative_error'])
+        stats.count = data['count']
+        stats.mean = data['mean']
+        stats.m2 = data['m2']
+        stats.min = data['min']
+        stats.max = data['max']
+        stats.buckets = {int(index): count for index, count in data['buckets'].items()}
+        return stats
+
+    def print_report(self):
+        p50, p90, p99 = (self.quantile(q) for q in QUANTILES)
+        print(f"Total data points: {self.count}")
+        print(f"Average execution time: {self.mean:.2f} seconds")
+        print(f"p50 / p90 / p99 execution time: {p50:.2f} / {p90:.2f} / {p99:.2f} seconds")
+        print(f"Max execution time: {self.max:.2f} seconds")
+        print(f"Min execution time: {self.min:.2f} seconds")
+        print(f"Standard deviation: {self.stdev:.2f} seconds")
+
+
+class LatencyBook:
+    """One ``LatencyStats`` per (model, temperature)."""
+
+    def __init__(self):
+        self.stats = {}
+
+    def get(self, model, temperature):
+        return self.stats.setdefault((model, float(temperature)), LatencyStats())
+
+    def add(self, model, temperature, value):
+        self.get(model, temperature).add(value)
+
+    def merge(self, other):
+        for (model, temperature), stats in other.stats.items():
+            self.get(model, temperature).merge(stats)
+        return self
+
+
+def book_from_ledger(path):
+    book = LatencyBook()
+    name = os.path.splitext(os.path.basename(path))[0]
+    for record in ledger.ExecutionLedger(path):
+        if record.get('time') is None:
+            continue
+        model = record['job'].split('/', 1)[0] if record.get('job') else name
+        book.add(model, record['temperature'], record['time'])
+    return book
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('ledger_files', nargs='+', help='time/*.jsonl ledgers (or their .xlsx names)')
+    args = parser.parse_args()
+    book = LatencyBook()
+    for path in args.ledger_files:
+        book.merge(book_from_ledger(ledger.ledger_path(path)))
+    print(f"{'model':<40}{'temp':>6}{'n':>7}{'mean':>8}{'stdev':>8}{'p50':>8}{'p90':>8}{'p99':>8}{'max':>8}")
+    for (model, temperature), stats in sorted(book.stats.items()):
+        p50, p90, p99 = (stats.quantile(q) for q in QUANTILES)
+        print(f"{model:<40}{temperature:>6}{stats.count:>7}{stats.mean:>8.2f}{stats.stdev:>8.2f}"
+              f"{p50:>8.2f}{p90:>8.2f}{p99:>8.2f}{stats.max:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
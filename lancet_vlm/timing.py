@@ -0,0 +1,130 @@
+"""Per-stage wall-clock timing for each job.
+
+An analyzer opens one ``JobTimer`` per case and wraps its stages (manifest
+lookup, image encode, request build, each network attempt, backoff sleeps,
+parse and persist) in ``timer.stage(name)``. The stage totals, attempt and
+retry counts (with ``timer.count`` for refusals and unparsable responses)
+are stored with the job's ledger record.
+
+Usage (from the folder the analyzers were run in):
+
+    python -m lancet_vlm.timing time/*.jsonl
+"""
+import argparse
+import contextlib
+import os
+import time
+
+from lancet_vlm import ledger
+
+STAGES = ('manifest', 'encode', 'build', 'network', 'backoff', 'parse', 'persist')
+
+
+class JobTimer:
+    def __init__(self):
+        self.started = time.time()
+        self.clock_start = time.perf_counter()
+        self.spans = []
+        self.open_spans = []
+        self.events = {}
+
+    def count(self, event):
+        """Count a retry cause that is not an exception, e.g. 'refusals' or 'parse_failures'."""
+        self.events[event] = self.events.get(event, 0) + 1
+
+    @contextlib.contextmanager
+    def stage(self, name, **attributes):
+        """Time a block; stages opened inside it are recorded as its children."""
+        span = {
+            'name': name,
+            'span_id': os.urandom(8).hex(),
+            'parent_id': self.open_spans[-1]['span_id'] if self.open_spans else None,
+            'start': time.time(),
+            'attributes': attributes,
+        }
+        clock_start = time.perf_counter()
+        self.open_spans.append(span)
+        try:
+            yield span
+        except BaseException as e:
+            span['error'] = type(e).__name__
+            raise
+        finally:
+            self.open_spans.pop()
+            span['duration'] = time.perf_counter() - clock_start
+            self.spans.append(span)
+
+    def totals(self):
+        """Seconds per stage in ``STAGES``; wrapper spans such as 'analyze' are not counted."""
+        totals = dict.fromkeys(STAGES, 0.0)
+        for span in self.spans:
+            if span['name'] in totals:
+                totals[span['name']] += span['duration']
+        return totals
+
+    def attempt_times(self):
+        return [span['duration'] for span in self.spans if span['name'] == 'network']
+
+    def ledger_fields(self):
+        attempt_times = self.attempt_times()
+        fields = {f"stage_{name}": round(seconds, 6) for name, seconds in self.totals().items()}
+        fields['wall_time'] = round(time.perf_counter() - self.clock_start, 6)
+        fields['attempts'] = len(attempt_times)
+        fields['retries'] = max(len(attempt_times) - 1, 0)
+        fields['attempt_times'] = [round(seconds, 6) for seconds in attempt_times]
+        fields.update(self.events)
+        return fields
+
+
+def summarise(records):
+    """Mean seconds per job for each stage, grouped by model."""
+    by_model = {}
+    for record in records:
+        if not record.get('job') or record.get('wall_time') is None:
+            continue
+        model = record['job'].split('/', 1)[0]
+        totals = by_model.setdefault(model, {'jobs': 0, 'wall_time': 0.0, 'attempts': 0, 'retries': 0})
+        totals['jobs'] += 1
+        totals['wall_time'] += record['wall_time']
+        totals['attempts'] += record.get('attempts') or 0
+        totals['retries'] += record.get('retries') or 0
+        for name in STAGES:
+            totals[name] = totals.get(name, 0.0) + (record.get(f"stage_{name}") or 0.0)
+    return by_model
+
+
+def print_summary(by_model):
+    header = f"{'model':<24}{'jobs':>6}{'wall':>9}" + ''.join(f"{name:>10}" for name in STAGES)
+    header += f"{'other':>9}{'tries':>7}"
+    print(header)
+    for model, totals in sorted(by_model.items()):
+        jobs = totals['jobs']
+        other = totals['wall_time'] - sum(totals[name] for name in STAGES)
+        line = f"{model:<24}{jobs:>6}{totals['wall_time'] / jobs:>9.2f}"
+        line += ''.join(f"{totals[name] / jobs:>10.3f}" for name in STAGES)
+        line += f"{other / jobs:>9.3f}{totals['attempts'] / jobs:>7.2f}"
+        print(line)
+        shares = ', '.join(
+            f"{name} {100 * totals[name] / totals['wall_time']:.0f}%"
+            for name in STAGES if totals['wall_time'] and totals[name]
+        )
+        print(f"{'':<24}share of wall time: {shares}; {totals['retries']} retries")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('ledger_files', nargs='+', help='time/*.jsonl ledgers (or their .xlsx names)')
+    args = parser.parse_args()
+    records = []
+    for path in args.ledger_files:
+        records.extend(ledger.ExecutionLedger(ledger.ledger_path(path)))
+    by_model = summarise(records)
+    if not by_model:
+        print("No timed jobs found")
+        return
+    print("Mean seconds per job")
+    print_summary(by_model)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""OTLP-JSON trace export of each job's ``JobTimer`` spans.
+
+Every finished job becomes one trace: a root ``job`` span carrying the job
+key, model, task, case, temperature, try, payload bytes and status, with the
+timer's spans (manifest lookup, image encode, the ``analyze`` call and its
+request builds, API attempts and backoff sleeps, parse and persist) as
+children. Each trace is one ``ExportTraceServiceRequest`` JSON line in
+``traces/<model>_<task>_<run id>.jsonl``, the layout the OpenTelemetry
+Collector's file exporter writes, so it can be loaded into Jaeger or
+replayed through a collector.
+"""
+import json
+import os
+import time
+
+TRACE_FOLDER = 'traces'
+SERVICE_NAME = 'lancet_vlm'
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_CLIENT = 3
+
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+def attribute_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def attributes(values):
+    return [
+        {'key': key, 'value': attribute_value(value)}
+        for key, value in values.items() if value is not None
+    ]
+
+
+def nanos(seconds):
+    return str(int(seconds * 1e9))
+
+
+def make_span(trace_id, span_id, parent_id, name, start, end, values, error=None, kind=SPAN_KIND_INTERNAL):
+    span = {
+        'traceId': trace_id,
+        'spanId': span_id,
+        'name': name,
+        'kind': kind,
+        'startTimeUnixNano': nanos(start),
+        'endTimeUnixNano': nanos(end),
+        'attributes': attributes(values),
+        'status': {'code': STATUS_ERROR, 'message': error} if error else {'code': STATUS_OK},
+    }
+    if parent_id:
+        span['parentSpanId'] = parent_id
+    return span
+
+
+class TraceExporter:
+    """Queues one trace per job on a ``BackgroundWriter``, which appends them in batches."""
+
+    # Traces are diagnostics; result rows and ledger records never wait on them.
+    independent = True
+
+    def __init__(self, path, writer, resource):
+        self.path = path
+        self.writer = writer
+        self.resource = attributes(resource)
+
+    def export_job(self, timer, job, status, **values):
+        trace_id = os.urandom(16).hex()
+        root_id = os.urandom(8).hex()
+        end = time.time()
+        root_values = {'lancet.job': job, 'lancet.status': status}
+        root_values.update({f"lancet.{key}": value for key, value in values.items()})
+        spans = [make_span(trace_id, root_id, None, 'job', timer.started, end, root_values,
+                           None if status == 'ok' else status)]
+        for span in timer.spans:
+            spans.append(make_span(
+                trace_id, span['span_id'], span['parent_id'] or root_id, span['name'],
+                span['start'], span['start'] + span['duration'],
+                {f"lancet.{key}": value for key, value in span['attributes'].items()},
+                span.get('error'),
+                SPAN_KIND_CLIENT if span['name'] == 'network' else SPAN_KIND_INTERNAL,
+            ))
+        request = {'resourceSpans': [{
+            'resource': {'attributes': self.resource},
+            'scopeSpans': [{'scope': {'name': SERVICE_NAME}, 'spans': spans}],
+        }]}
+        self.writer.submit(self, json.dumps(request, separators=(',', ':')))
+
+    def write_batch(self, lines):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'a') as trace_file:
+            trace_file.write(''.join(line + '\n' for line in lines))
+
+
+def open_tracer(model, task, writer, run_id=None):
+    run_id = run_id or f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+    path = os.path.join(TRACE_FOLDER, f"{model}_{task}_{run_id}.jsonl")
+    resource = {
+        'service.name': SERVICE_NAME,
+        'service.instance.id': run_id,
+        'lancet.model': model,
+        'lancet.task': task,
+    }
+    return TraceExporter(path, writer, resource)
@@ -0,0 +1,270 @@
+"""Token and cost accounting from the SDKs' usage fields.
+
+Each job collects the input, output and cached tokens, model version and
+finish reason reported by every API attempt (refused and retried attempts
+are billed too), plus an estimate of the image tokens per request from the
+encoded images' dimensions. The totals and their cost from ``PRICES`` are
+stored with the result row and the ledger record. ``TokenBudget`` throttles
+requests to a tokens-per-minute limit (``LANCET_TPM``).
+
+Usage (from the folder the analyzers were run in):
+
+    python -m lancet_vlm.usage time/*.jsonl
+"""
+import argparse
+import base64
+import collections
+import io
+import math
+import os
+import time
+
+from PIL import Image
+
+from lancet_vlm import ledger
+
+# USD per million (input, output) tokens at the prompt lengths used here.
+PRICES = {
+    'gpt-4-turbo': (10.0, 30.0),
+    'gpt-4o': (5.0, 15.0),
+    'gemini-1.5-pro': (3.5, 10.5),
+    'gemini-1.5-flash': (0.35, 1.05),
+    'claude-3-opus-20240229': (15.0, 75.0),
+    'claude-3-5-sonnet-20240620': (3.0, 15.0),
+}
+
+# Share of the input price charged for cached prompt tokens read and written.
+CACHE_READ_FACTOR = {'openai': 0.5, 'anthropic': 0.1, 'gemini': 1.0}
+CACHE_WRITE_FACTOR = {'openai': 1.0, 'anthropic': 1.25, 'gemini': 1.0}
+
+# Environment variable holding a tokens-per-minute limit, e.g. "30000".
+TPM_ENV = 'LANCET_TPM'
+TPM_WINDOW = 60.0
+
+
+def provider_for(model):
+    if model.startswith('gpt'):
+        return 'openai'
+    if model.startswith('claude'):
+        return 'anthropic'
+    return 'gemini'
+
+
+def image_size(encoded_image):
+    with Image.open(io.BytesIO(base64.b64decode(encoded_image))) as image:
+        return image.size
+
+
+def openai_image_tokens(width, height):
+    """High-detail tiling: fit within 2048x2048, shortest side to 768, 170 per 512px tile plus 85."""
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def image_tokens(provider, encoded_images):
+    """Estimated input tokens for the images of one request."""
+    if provider == 'gemini':
+        return 258 * len(encoded_images)
+    total = 0
+    for encoded_image in encoded_images:
+        width, height = image_size(encoded_image)
+        if provider == 'openai':
+            total += openai_image_tokens(width, height)
+        else:
+            total += math.ceil(width * height / 750)
+    return total
+
+
+def openai_usage(response):
+    usage = response.usage
+    details = getattr(usage, 'prompt_tokens_details', None)
+    return {
+        'input_tokens': usage.prompt_tokens,
+        'output_tokens': usage.completion_tokens,
+        'cached_tokens': getattr(details, 'cached_tokens', None) or 0,
+        'model_version': response.model,
+        'finish_reason': response.choices[0].finish_reason,
+    }
+
+
+def anthropic_usage(response):
+    usage = response.usage
+    cached_tokens = getattr(usage, 'cache_read_input_tokens', None) or 0
+    cache_write_tokens = getattr(usage, 'cache_creation_input_tokens', None) or 0
+    return {
+        # input_tokens excludes the cached prefix, so add it back for a comparable total.
+        'input_tokens': usage.input_tokens + cached_tokens + cache_write_tokens,
+        'output_tokens': usage.output_tokens,
+        'cached_tokens': cached_tokens,
+        'cache_write_tokens': cache_write_tokens,
+        'model_version': response.model,
+        'finish_reason': response.stop_reason,
+    }
+
+
+def gemini_usage(response):
+    usage = response.usage_metadata
+    finish_reason = response.candidates[0].finish_reason if response.candidates else None
+    return {
+        'input_tokens': usage.prompt_token_count,
+        'output_tokens': usage.candidates_token_count,
+        'cached_tokens': getattr(usage, 'cached_content_token_count', None) or 0,
+        'model_version': getattr(response, 'model_version', None),
+        'finish_reason': getattr(finish_reason, 'name', finish_reason),
+    }
+
+
+EXTRACTORS = {'openai': openai_usage, 'anthropic': anthropic_usage, 'gemini': gemini_usage}
+
+
+def cost(model, input_tokens, output_tokens, cached_tokens=0, cache_write_tokens=0):
+    if model not in PRICES:
+        return None
+    input_price, output_price = PRICES[model]
+    provider = provider_for(model)
+    uncached = input_tokens - cached_tokens - cache_write_tokens
+    billed_input = (
+        uncached
+        + cached_tokens * CACHE_READ_FACTOR[provider]
+        + cache_write_tokens * CACHE_WRITE_FACTOR[provider]
+    )
+    return (billed_input * input_price + output_tokens * output_price) / 1e6
+
+
+class JobUsage:
+    def __init__(self):
+        self.requests = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cached_tokens = 0
+        self.cache_write_tokens = 0
+        self.image_tokens_per_request = 0
+        self.model_versions = []
+        self.finish_reasons = []
+
+    def add(self, input_tokens=0, output_tokens=0, cached_tokens=0, cache_write_tokens=0, model_version=None,
+            finish_reason=None):
+        self.requests += 1
+        self.input_tokens += input_tokens or 0
+        self.output_tokens += output_tokens or 0
+        self.cached_tokens += cached_tokens or 0
+        self.cache_write_tokens += cache_write_tokens or 0
+        if model_version and model_version not in self.model_versions:
+            self.model_versions.append(model_version)
+        self.finish_reasons.append(str(finish_reason) if finish_reason is not None else None)
+
+    def add_response(self, provider, response):
+        """Add one attempt's usage; a response without usage fields is counted with zero tokens."""
+        try:
+            fields = EXTRACTORS[provider](response)
+        except (AttributeError, IndexError, TypeError):
+            fields = {}
+        self.add(**fields)
+
+    @property
+    def total_tokens(self):
+        return self.input_tokens + self.output_tokens
+
+    def as_dict(self, model):
+        return {
+            'requests': self.requests,
+            'input_tokens': self.input_tokens,
+            'output_tokens': self.output_tokens,
+            'image_tokens': self.image_tokens_per_request * self.requests,
+            'cached_tokens': self.cached_tokens,
+            'cache_write_tokens': self.cache_write_tokens,
+            'model_versions': self.model_versions,
+            'finish_reasons': self.finish_reasons,
+            'cost_usd': cost(model, self.input_tokens, self.output_tokens, self.cached_tokens,
+                             self.cache_write_tokens),
+        }
+
+    def ledger_fields(self, model):
+        fields = self.as_dict(model)
+        fields['model_version'] = ','.join(fields.pop('model_versions')) or None
+        finish_reasons = [reason for reason in fields.pop('finish_reasons') if reason]
+        fields['finish_reason'] = finish_reasons[-1] if finish_reasons else None
+        del fields['requests']
+        return fields
+
+
+class TokenBudget:
+    """Sliding one-minute token window; ``acquire`` blocks until a request's estimate fits."""
+
+    def __init__(self, tokens_per_minute=None):
+        self.tokens_per_minute = tokens_per_minute
+        self.window = collections.deque()
+        self.used = 0
+
+    def expire(self, now):
+        while self.window and now - self.window[0][0] >= TPM_WINDOW:
+            self.used -= self.window.popleft()[1]
+
+    def acquire(self, tokens):
+        """Wait until ``tokens`` more fit in the window; returns the seconds waited."""
+        if not self.tokens_per_minute:
+            return 0.0
+        waited = 0.0
+        while True:
+            now = time.monotonic()
+            self.expire(now)
+            if not self.window or self.used + tokens <= self.tokens_per_minute:
+                return waited
+            delay = TPM_WINDOW - (now - self.window[0][0])
+            time.sleep(delay)
+            waited += delay
+
+    def record(self, tokens):
+        if self.tokens_per_minute and tokens:
+            self.window.append((time.monotonic(), tokens))
+            self.used += tokens
+
+
+def open_budget():
+    tokens_per_minute = os.getenv(TPM_ENV)
+    return TokenBudget(int(tokens_per_minute) if tokens_per_minute else None)
+
+
+def summarise(records):
+    """Token, throughput and cost totals per (model, task, temperature)."""
+    groups = {}
+    for record in records:
+        if not record.get('job') or record.get('input_tokens') is None:
+            continue
+        model, task, _ = record['job'].split('/', 2)
+        totals = groups.setdefault((model, task, record['temperature']), collections.Counter())
+        totals['jobs'] += 1
+        for field in ('input_tokens', 'output_tokens', 'image_tokens', 'cached_tokens', 'cache_write_tokens',
+                      'stage_network'):
+            totals[field] += record.get(field) or 0
+        totals['cost_usd'] += record.get('cost_usd') or 0.0
+    return groups
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('ledger_files', nargs='+', help='time/*.jsonl ledgers (or their .xlsx names)')
+    args = parser.parse_args()
+    records = []
+    for path in args.ledger_files:
+        records.extend(ledger.ExecutionLedger(ledger.ledger_path(path)))
+    groups = summarise(records)
+    if not groups:
+        print("No jobs with token usage found")
+        return
+    print(f"{'model':<28}{'task':<26}{'temp':>5}{'jobs':>6}{'input':>10}{'output':>9}{'image':>9}"
+          f"{'cached':>9}{'hit %':>7}{'written':>9}{'out tok/s':>10}{'cost $':>9}{'$/case':>8}")
+    for (model, task, temperature), totals in sorted(groups.items()):
+        tokens_per_second = totals['output_tokens'] / totals['stage_network'] if totals['stage_network'] else 0.0
+        hit_rate = 100 * totals['cached_tokens'] / totals['input_tokens'] if totals['input_tokens'] else 0.0
+        print(f"{model:<28}{task:<26}{temperature:>5}{totals['jobs']:>6}{totals['input_tokens']:>10}"
+              f"{totals['output_tokens']:>9}{totals['image_tokens']:>9}{totals['cached_tokens']:>9}"
+              f"{hit_rate:>7.1f}{totals['cache_write_tokens']:>9}{tokens_per_second:>10.1f}"
+              f"{totals['cost_usd']:>9.2f}{totals['cost_usd'] / totals['jobs']:>8.4f}")
+
+
+if __name__ == "__main__":
+    main()
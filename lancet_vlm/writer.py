@@ -0,0 +1,166 @@
+"""Background writer thread for result rows, ledger records and Excel summaries.
+
+The request loop only queues items; a single thread writes them in batches
+when ``FLUSH_ROWS`` items are pending, every ``FLUSH_INTERVAL`` seconds, on
+``flush()`` and at shutdown. Sinks are flushed in the order they first
+ever received an item, so a job's result row is committed before its ledger
+record marks it done. A sink is any object with ``write_batch(items)``.
+
+When a sink fails, it and the sinks after it stay pending and are retried
+on the next flush. The exception is a sink marked ``independent``, such as
+the Excel summaries, traces and cassettes. Nothing waits on such a sink, so a
+locked workbook never holds back result rows or ledger records.
+``flush(through=sink)`` writes only ``sink`` and the sinks before it that are
+not independent, which is how the ledger persists each job without waiting
+for traces or summaries.
+"""
+import atexit
+import os
+import queue
+import threading
+import time
+
+import pandas as pd
+
+FLUSH_ROWS = 32
+FLUSH_INTERVAL = 5.0
+
+SUMMARY_FILE_NAME = 'analysis_results.xlsx'
+
+# The summary workbook is rewritten whole, so it is written less often.
+SUMMARY_INTERVAL = 60.0
+
+_FLUSH = object()
+_STOP = object()
+_CLOSE_SUMMARY = object()
+
+
+class Summary:
+    """Parsed rows for one result folder's analysis_results.xlsx, collected in a list."""
+
+    independent = True
+
+    def __init__(self, writer, result_folder, columns):
+        self.writer = writer
+        self.excel_path = os.path.join(result_folder, SUMMARY_FILE_NAME)
+        self.columns = columns
+        self.rows = []
+        self.closed = False
+        self.last_write = time.monotonic()
+
+    def append(self, row):
+        self.writer.submit(self, row)
+
+    def close(self):
+        self.writer.submit(self, _CLOSE_SUMMARY)
+
+    def write_batch(self, items):
+        # A failed write leaves the batch pending, so the rows are only kept once it succeeds.
+        rows = self.rows + [item for item in items if item is not _CLOSE_SUMMARY]
+        closed = self.closed or any(item is _CLOSE_SUMMARY for item in items)
+        if closed or time.monotonic() - self.last_write >= SUMMARY_INTERVAL:
+            self.write(rows)
+        self.rows = rows
+        self.closed = closed
+
+    def write(self, rows):
+        os.makedirs(os.path.dirname(self.excel_path) or '.', exist_ok=True)
+        pd.DataFrame(rows, columns=self.columns).to_excel(self.excel_path, index=False)
+        self.last_write = time.monotonic()
+
+
+class BackgroundWriter:
+    def __init__(self, flush_rows=FLUSH_ROWS, flush_interval=FLUSH_INTERVAL):
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.sinks = []
+        self.pending = {}
+        self.pending_count = 0
+        self.thread = threading.Thread(target=self.run, name='lancet-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def submit(self, sink, item):
+        self.queue.put((sink, item))
+
+    def summary(self, result_folder, columns):
+        return Summary(self, result_folder, columns)
+
+    def run(self):
+        last_flush = time.monotonic()
+        while True:
+            timeout = max(0.0, last_flush + self.flush_interval - time.monotonic())
+            try:
+                sink, item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                sink = item = None
+
+            if sink is _FLUSH or sink is _STOP:
+                done, through, written = item
+                written.append(self.write_pending(through))
+                if through is None:
+                    last_flush = time.monotonic()
+                done.set()
+                if sink is _STOP:
+                    return
+                continue
+
+            if sink is not None:
+                if sink not in self.pending and sink not in self.sinks:
+                    self.sinks.append(sink)
+                self.pending.setdefault(sink, []).append(item)
+                self.pending_count += 1
+            if self.pending_count >= self.flush_rows or time.monotonic() - last_flush >= self.flush_interval:
+                self.write_pending()
+                last_flush = time.monotonic()
+
+    def write_pending(self, through=None):
+        """Write pending batches in sink order, up to and including ``through`` if given.
+
+        Returns False when a sink that later sinks wait on failed, leaving them pending.
+        """
+        for sink in self.sinks:
+            independent = getattr(sink, 'independent', False)
+            skipped = through is not None and independent and sink is not through
+            if sink in self.pending and not skipped:
+                items = self.pending[sink]
+                try:
+                    sink.write_batch(items)
+                except Exception as e:
+                    print(f"Error: background write to {sink!r} failed - {e}")
+                    if not independent:
+                        # Keep this and later sinks pending so order is preserved on the next try.
+                        return False
+                else:
+                    del self.pending[sink]
+                    self.pending_count -= len(items)
+            if sink is through:
+                break
+        return True
+
+    def wait(self, marker, through=None):
+        if not self.thread.is_alive():
+            return False
+        done = threading.Event()
+        written = []
+        self.queue.put((marker, (done, through, written)))
+        done.wait()
+        return written[0]
+
+    def flush(self, through=None):
+        """Block until everything queued so far is written; False if some of it is still pending.
+
+        With ``through``, only that sink and the sinks before it that are not
+        ``independent`` are written.
+        """
+        return self.wait(_FLUSH, through)
+
+    def close(self):
+        self.wait(_STOP)
+        for sink in self.sinks:
+            if sink in self.pending:
+                print(f"Error: {len(self.pending[sink])} items for {sink!r} were not written")
+            elif hasattr(sink, 'sync'):
+                sink.sync()
+        atexit.unregister(self.close)